@@ -12,8 +12,12 @@ def register():
         analytic.AnalyticAccountAccountRequired,
         analytic.AnalyticAccountAccountForbidden,
         analytic.AnalyticAccountAccountOptional,
+        analytic.AnalyticRule,
         analytic.AnalyticLine,
+        analytic.AnalyticLineBalance,
+        analytic.AnalyticLineTotal,
         account.Account,
+        account.Period,
         account.Move,
         account.MoveLine,
         module='analytic_line_state', type_='model')
@@ -1,16 +1,115 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from itertools import chain
-
-from trytond.model import Model, ModelView, fields, dualmethod
+import logging
+from itertools import product
+from weakref import WeakKeyDictionary
+
+from sql import Literal, Union
+from sql.aggregate import Count
+from sql.functions import Round
+from sql.operators import Exists
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.model import Model, ModelView, Workflow, fields, dualmethod
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Bool
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
 from trytond.model.exceptions import AccessError
 from trytond.model.exceptions import ValidationError
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 
+from .instrumentation import instrumented
+
+logger = logging.getLogger(__name__)
+_rule_matchers = WeakKeyDictionary()
+_must_have_analytic_cache = WeakKeyDictionary()
+
+
+class AnalyticValidationDataManager(object):
+    '''
+    Queue the move lines whose analytic lines must be validated and validate
+    them once just before the transaction is committed.
+    '''
+
+    def __init__(self):
+        self.line_ids = set()
+
+    def put(self, lines):
+        self.line_ids.update(l.id for l in lines
+            if l and l.id is not None and l.id >= 0)
+
+    def validate(self):
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        line_ids, self.line_ids = self.line_ids, set()
+        if line_ids:
+            with Transaction().set_context(defer_analytic_validation=False):
+                MoveLine.validate_analytic_lines(
+                    MoveLine.browse(sorted(line_ids)))
+
+    def __eq__(self, other):
+        if not isinstance(other, AnalyticValidationDataManager):
+            return NotImplemented
+        return True
+
+    def abort(self, trans):
+        self.line_ids.clear()
+
+    def tpc_begin(self, trans):
+        self.validate()
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        pass
+
+    def tpc_abort(self, trans):
+        self.line_ids.clear()
+
+
+class AnalyticRuleMatcher(object):
+    '''
+    Index of the analytic rules by company, account, journal and party that
+    returns the first rule matching a pattern like MatchMixin.match.
+    '''
+    fields = ('company', 'account', 'journal', 'party')
+
+    def __init__(self, rules):
+        self.rules = rules
+        # {(company, account, journal, party): index of the first rule}
+        self.index = {}
+        for i, rule in enumerate(rules):
+            key = tuple(
+                getattr(rule, f).id if getattr(rule, f) else None
+                for f in self.fields)
+            self.index.setdefault(key, i)
+
+    def match(self, pattern):
+        if set(pattern) != set(self.fields):
+            for rule in self.rules:
+                if rule.match(pattern):
+                    return rule
+            return
+
+        # The rules with an empty field match any value
+        company, account, journal, party = (
+            pattern[f] for f in self.fields)
+        first = None
+        for key in product([company], {account, None}, {journal, None},
+                {party, None}):
+            i = self.index.get(key)
+            if i is not None and (first is None or i < first):
+                first = i
+        if first is not None:
+            return self.rules[first]
+
 
 class Configuration(metaclass=PoolMeta):
     __name__ = 'account.configuration'
@@ -57,8 +156,11 @@ class Account(metaclass=PoolMeta):
             'Pending Accounts', states={
                 'invisible':~Bool(Eval('type')),
                 }),
-        'on_change_with_analytic_pending_accounts')
-
+        'get_analytic_pending_accounts')
+    _analytic_constraint_cache = Cache(__name__ + '.analytic_constraint',
+        context=False)
+    _analytic_pending_cache = Cache(__name__ + '.analytic_pending_roots',
+        context=False)
 
     @fields.depends('analytic_required', 'analytic_forbidden',
             'analytic_optional', 'company')
@@ -75,14 +177,151 @@ class Account(metaclass=PoolMeta):
                 ])
         return [x.id for x in pending_accounts]
 
+    @classmethod
+    def get_analytic_pending_accounts(cls, accounts, name):
+        '''
+        Return the active analytic roots of the company of each account that
+        are not configured: {account_id: [root_id]}
+        '''
+        pool = Pool()
+        AnalyticAccount = pool.get('analytic_account.account')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        root = AnalyticAccount.__table__()
+
+        result = {a.id: [] for a in accounts}
+        query = table.join(root, condition=root.company == table.company)
+        for sub_ids in grouped_slice(result.keys()):
+            cursor.execute(*query.select(table.id, root.id,
+                    where=reduce_ids(table.id, sub_ids)
+                    & (root.type == 'root')
+                    & (root.active == Literal(True))
+                    & ~cls._analytic_configured(table, root),
+                    order_by=[table.id, root.id]))
+            for account, root_id in cursor:
+                result[account].append(root_id)
+        return result
+
+    @classmethod
+    def _analytic_configured(cls, account, root):
+        '''
+        Return the condition of the pairs of the account and analytic root
+        tables that have a constraint configured.
+        '''
+        pool = Pool()
+        queries = []
+        for constraint in ('required', 'forbidden', 'optional'):
+            Relation = pool.get(
+                'analytic_account.account-%s-account.account' % constraint)
+            relation = Relation.__table__()
+            queries.append(relation.select(Literal(1),
+                    where=(relation.account == account.id)
+                    & (relation.analytic_account == root.id)))
+        return Exists(Union(*queries, all_=True))
+
+    @classmethod
+    def analytic_constraints(cls):
+        '''
+        Return a dictionary with the constraint of each analytic root for each
+        account: {account_id: {root_id: constraint}}
+        '''
+        constraints = cls._analytic_constraint_cache.get(None)
+        if constraints is not None:
+            return constraints
+
+        pool = Pool()
+        cursor = Transaction().connection.cursor()
+
+        queries = []
+        for constraint in ('required', 'forbidden', 'optional'):
+            Relation = pool.get(
+                'analytic_account.account-%s-account.account' % constraint)
+            relation = Relation.__table__()
+            queries.append(relation.select(
+                    relation.account, relation.analytic_account,
+                    Literal(constraint)))
+        cursor.execute(*Union(*queries, all_=True))
+
+        # Keep the precedence of required over forbidden over optional
+        priority = {'required': 0, 'forbidden': 1, 'optional': 2}
+        constraints = {}
+        for account, root, constraint in cursor:
+            roots = constraints.setdefault(account, {})
+            if (root not in roots
+                    or priority[constraint] < priority[roots[root]]):
+                roots[root] = constraint
+        return cls._analytic_constraint_cache.set(None, constraints)
+
+    @classmethod
+    def analytic_pending_roots(cls):
+        '''
+        Return a dictionary with the active analytic roots of its company that
+        are not configured for each account: {account_id: [root_id]}
+        Accounts without pending roots are not included.
+        '''
+        pending = cls._analytic_pending_cache.get(None)
+        if pending is not None:
+            return pending
+
+        pool = Pool()
+        AnalyticAccount = pool.get('analytic_account.account')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        analytic_account = AnalyticAccount.__table__()
+
+        constraints = cls.analytic_constraints()
+
+        cursor.execute(*analytic_account.select(
+                analytic_account.company, analytic_account.id,
+                where=(analytic_account.type == 'root')
+                & (analytic_account.active == Literal(True))))
+        company_roots = {}
+        for company, root in cursor:
+            company_roots.setdefault(company, set()).add(root)
+
+        pending = {}
+        cursor.execute(*table.select(table.id, table.company))
+        for account, company in cursor:
+            roots = (company_roots.get(company, set())
+                - set(constraints.get(account, {})))
+            if roots:
+                pending[account] = sorted(roots)
+        return cls._analytic_pending_cache.set(None, pending)
+
+    @classmethod
+    def _clear_analytic_cache(cls):
+        cls._analytic_constraint_cache.clear()
+        cls._analytic_pending_cache.clear()
+        _must_have_analytic_cache.pop(Transaction(), None)
+
     def analytic_constraint(self, analytic_account):
-        if analytic_account.root in self.analytic_required:
-            return 'required'
-        elif analytic_account.root in self.analytic_forbidden:
-            return 'forbidden'
-        elif analytic_account.root in self.analytic_optional:
-            return 'optional'
-        return 'undefined'
+        AnalyticAccount = Pool().get('analytic_account.account')
+        if analytic_account.id is None or analytic_account.id < 0:
+            root = analytic_account.root
+            root_id = root.id if root else None
+        else:
+            root_id = AnalyticAccount.get_roots(
+                [analytic_account.id]).get(analytic_account.id)
+        if not root_id:
+            return 'undefined'
+        return self.analytic_constraints().get(self.id, {}).get(
+            root_id, 'undefined')
+
+    @classmethod
+    def create(cls, vlist):
+        accounts = super(Account, cls).create(vlist)
+        cls._clear_analytic_cache()
+        return accounts
+
+    @classmethod
+    def write(cls, *args):
+        super(Account, cls).write(*args)
+        cls._clear_analytic_cache()
+
+    @classmethod
+    def delete(cls, accounts):
+        super(Account, cls).delete(accounts)
+        cls._clear_analytic_cache()
 
     @classmethod
     def validate(cls, accounts):
@@ -122,70 +361,189 @@ class Move(metaclass=PoolMeta):
 
     @dualmethod
     @ModelView.button
+    @instrumented('account.move.post')
     def post(cls, moves):
         super(Move, cls).post(moves)
-        for move in moves:
-            origin = ''
-            origin_model = ''
-            # Ensure that "move.origin" is an instance because if a reference
-            # field is assigned a model name but not an id "move.origin" will
-            # return an str
-            if move.origin and isinstance(move.origin, Model):
-                origin = move.origin.rec_name
-                origin_model = move.origin.__names__().get('model')
-            if move.period.type == 'adjustment':
-                continue
-            for line in move.lines:
-                required_roots = list(line.account.analytic_required[:])
-                if not line.analytic_lines and line.account.analytic_required:
-                    raise UserError(gettext(
-                        'analytic_line_state.missing_analytic_lines',
-                            move=move.rec_name,
-                            account="[%s] %s" % (line.account.code,
-                                line.account.name),
-                            roots=', '.join(r.rec_name
-                                for r in required_roots),
-                            origin=origin,
-                            origin_model=origin_model,
-                            ))
-                for analytic_line in line.analytic_lines:
-                    if analytic_line.account.root in required_roots:
-                        required_roots.remove(analytic_line.account.root)
-                    constraint = line.account.analytic_constraint(
-                        analytic_line.account)
-                    if (constraint == 'required' and
-                            analytic_line.state != 'valid'):
-                        raise UserError(gettext(
-                            'analytic_line_state.invalid_analytic_to_post_move',
-                                move=move.rec_name,
-                                line=line.rec_name,
-                                root=analytic_line.account.root.rec_name,
-                                ))
-                if required_roots:
-                    raise UserError(gettext(
+        cls.check_analytic_lines(moves)
+
+    @classmethod
+    def check_analytic_lines(cls, moves):
+        '''
+        Check that the lines of the moves have valid analytic lines for all
+        the required roots of their account and raise a single error with all
+        the failing moves.
+        '''
+        # The states of the deferred move lines must be up to date
+        Transaction().join(AnalyticValidationDataManager()).validate()
+
+        pool = Pool()
+        Account = pool.get('account.account')
+        AnalyticAccount = pool.get('analytic_account.account')
+        AnalyticLine = pool.get('analytic_account.line')
+        Balance = pool.get('analytic_account.line.balance')
+        MoveLine = pool.get('account.move.line')
+        Period = pool.get('account.period')
+        Required = pool.get(
+            'analytic_account.account-required-account.account')
+        cursor = Transaction().connection.cursor()
+        move = cls.__table__()
+        period = Period.__table__()
+        line = MoveLine.__table__()
+        required = Required.__table__()
+        balance = Balance.__table__()
+        analytic_line = AnalyticLine.__table__()
+        analytic_account = AnalyticAccount.__table__()
+        failure_line = MoveLine.__table__()
+
+        # {(move_id, line_id, account_id): ([missing_root], [invalid_root])}
+        failures = {}
+        for sub_ids in grouped_slice([m.id for m in moves]):
+            sub_ids = list(sub_ids)
+            # The (move line, root) pairs required by the account of the line
+            required_roots = line.join(move,
+                condition=move.id == line.move
+                ).join(period, condition=period.id == move.period
+                ).join(required, condition=required.account == line.account
+                ).select(line.id.as_('move_line'),
+                required.analytic_account.as_('root'),
+                where=reduce_ids(line.move, sub_ids)
+                & (period.type != 'adjustment'))
+            # The (move line, root) pairs that have analytic lines
+            present_roots = balance.join(line,
+                condition=line.id == balance.move_line
+                ).select(balance.move_line, balance.root,
+                where=reduce_ids(line.move, sub_ids))
+            missing = required_roots - present_roots
+            invalid = required_roots.join(analytic_line,
+                condition=analytic_line.move_line == required_roots.move_line
+                ).join(analytic_account,
+                condition=(analytic_account.id == analytic_line.account)
+                & (analytic_account.root == required_roots.root)
+                ).select(required_roots.move_line, required_roots.root,
+                where=analytic_line.state != 'valid',
+                group_by=[required_roots.move_line, required_roots.root])
+            failing = Union(
+                missing.select(missing.move_line, missing.root,
+                    Literal('missing').as_('kind')),
+                invalid.select(invalid.move_line, invalid.root,
+                    Literal('invalid').as_('kind')),
+                all_=True)
+            cursor.execute(*failing.join(failure_line,
+                    condition=failure_line.id == failing.move_line
+                    ).select(failure_line.move, failing.move_line,
+                    failure_line.account, failing.root, failing.kind,
+                    order_by=[failure_line.move, failing.move_line,
+                        failing.root]))
+            for move_id, line_id, account_id, root_id, kind in cursor:
+                missing_roots, invalid_roots = failures.setdefault(
+                    (move_id, line_id, account_id), ([], []))
+                if kind == 'missing':
+                    missing_roots.append(root_id)
+                else:
+                    invalid_roots.append(root_id)
+
+        if not failures:
+            return
+
+        errors = []
+        for (move_id, line_id, account_id), (missing, invalid) in (
+                failures.items()):
+            failing_move = cls(move_id)
+            failing_line = MoveLine(line_id)
+            account = Account(account_id)
+            for root_id in invalid:
+                errors.append(gettext(
+                        'analytic_line_state.invalid_analytic_to_post_move',
+                        move=failing_move.rec_name,
+                        line=failing_line.rec_name,
+                        root=AnalyticAccount(root_id).rec_name,
+                        ))
+            if missing:
+                origin = ''
+                origin_model = ''
+                # Ensure that "move.origin" is an instance because if a
+                # reference field is assigned a model name but not an id
+                # "move.origin" will return an str
+                move_origin = failing_move.origin
+                if move_origin and isinstance(move_origin, Model):
+                    origin = move_origin.rec_name
+                    origin_model = move_origin.__names__().get('model')
+                errors.append(gettext(
                         'analytic_line_state.missing_analytic_lines',
-                            move=move.rec_name,
-                            account="[%s] %s" % (line.account.code,
-                                line.account.name),
-                            roots=', '.join(r.rec_name
-                                for r in required_roots),
-                            origin=origin,
-                            origin_model=origin_model,
-                            ))
+                        move=failing_move.rec_name,
+                        account="[%s] %s" % (account.code, account.name),
+                        roots=', '.join(sorted(AnalyticAccount(r).rec_name
+                                for r in missing)),
+                        origin=origin,
+                        origin_model=origin_model,
+                        ))
+        raise UserError(gettext('analytic_line_state.moves_analytic_not_valid',
+                moves=', '.join(sorted({cls(m).rec_name
+                            for m, _, _ in failures}))),
+            '\n\n'.join(errors))
 
+    @instrumented('account.move._set_analytic_account_from_rule')
     def _set_analytic_account_from_rule(move):
+        '''
+        Set the analytic lines of the lines of the move from the analytic
+        rules before the move is saved.
+        '''
         pool = Pool()
         MoveLine = pool.get('account.move.line')
 
-        must_have_analytic = False
-        for line in move.lines:
-            if line._must_have_analytic():
-                must_have_analytic = True
-                break
-        if must_have_analytic:
-            move.save()
-            lines = move.lines
-            MoveLine.apply_rule(lines)
+        # The unset fields read by the rules are empty like they will be
+        # stored
+        if 'origin' not in move._values._keys():
+            move.origin = None
+        lines = list(move.lines)
+        for line in lines:
+            line.move = move
+            values = set(line._values._keys())
+            for name, value in [
+                    ('party', None),
+                    ('origin', None),
+                    ('analytic_lines', []),
+                    ]:
+                if name not in values:
+                    setattr(line, name, value)
+            # The journal and the period of the unsaved lines are read from
+            # the move but they are saved by the move
+            line.journal = move.journal
+            line.period = move.period
+        MoveLine.apply_rule(lines)
+        for line in lines:
+            line._values._pop('journal', None)
+            line._values._pop('period', None)
+
+
+class Period(metaclass=PoolMeta):
+    __name__ = 'account.period'
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('closed')
+    def close(cls, periods):
+        Total = Pool().get('analytic_account.line.total')
+        super(Period, cls).close(periods)
+        Total._fill([p.id for p in periods])
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('open')
+    def reopen(cls, periods):
+        Total = Pool().get('analytic_account.line.total')
+        super(Period, cls).reopen(periods)
+        Total._clear([p.id for p in periods])
+
+    @classmethod
+    def revalidate_analytic_lines(cls, periods, from_date=None, to_date=None,
+            accounts=None, start=None, end=None):
+        'Recompute the analytic states of a partition of the periods'
+        MoveLine = Pool().get('account.move.line')
+        MoveLine.revalidate_analytic_lines(from_date=from_date,
+            to_date=to_date, accounts=accounts,
+            periods=[p.id for p in periods], start=start, end=end,
+            commit=False)
 
 
 class MoveLine(metaclass=PoolMeta):
@@ -194,82 +552,345 @@ class MoveLine(metaclass=PoolMeta):
     @classmethod
     def validate(cls, lines):
         super(MoveLine, cls).validate(lines)
-        for line in lines:
-            line.check_account_analytic_configuration()
+        cls.check_account_analytic_configuration(lines)
 
-    def check_account_analytic_configuration(self):
+    @dualmethod
+    @instrumented('account.move.line.check_account_analytic_configuration')
+    def check_account_analytic_configuration(cls, lines):
         pool = Pool()
+        Account = pool.get('account.account')
         Config = pool.get('account.configuration')
         config = Config(1)
-        if config.validate_analytic:
-            if self.account.analytic_pending_accounts:
+        if not config.validate_analytic:
+            return
+        pending = Account.analytic_pending_roots()
+        for line in lines:
+            if line.account.id in pending:
                 raise ValidationError(gettext(
                     'analytic_line_state.account_analytic_not_configured',
-                        line=self.rec_name,
-                        account=self.account.rec_name,
+                        line=line.rec_name,
+                        account=line.account.rec_name,
                         ))
 
     @classmethod
+    @instrumented('account.move.line.validate_analytic_lines')
     def validate_analytic_lines(cls, lines):
+        '''
+        Set to valid the analytic lines of each root whose balance is equal
+        to the balance of its move line and to draft the other ones.
+
+        If the context has defer_analytic_validation, the lines are queued
+        and validated only once before the transaction is committed.
+        '''
+        transaction = Transaction()
+        if transaction.context.get('_skip_analytic_validation'):
+            return
+        if transaction.context.get('defer_analytic_validation'):
+            transaction.join(AnalyticValidationDataManager()).put(lines)
+            return
+
+        AnalyticLine = Pool().get('analytic_account.line')
+
+        ids = sorted({l.id for l in lines if l and l.id is not None
+                    and l.id >= 0})
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            AnalyticLine._set_state('draft',
+                cls._analytic_lines_query(sub_ids, False))
+            AnalyticLine._set_state('valid',
+                cls._analytic_lines_query(sub_ids, True))
+
+    @classmethod
+    def _analytic_lines_query(cls, ids, valid):
+        '''
+        Return the query of the ids of the analytic lines of the move lines
+        whose root balance is equal (valid) or not to the move line balance.
+        '''
         pool = Pool()
         AnalyticLine = pool.get('analytic_account.line')
+        AnalyticAccount = pool.get('analytic_account.account')
+        Balance = pool.get('analytic_account.line.balance')
+        move_line = cls.__table__()
+        balance = Balance.__table__()
+        analytic_line = AnalyticLine.__table__()
+        account = AnalyticAccount.__table__()
+
+        difference = balance.balance - (move_line.debit - move_line.credit)
+        if backend.name == 'sqlite':
+            # SQLite computes numeric values as floating point
+            difference = Round(difference, 6)
+        groups = balance.join(move_line,
+            condition=move_line.id == balance.move_line
+            ).select(balance.move_line, balance.root,
+            where=reduce_ids(balance.move_line, ids)
+            & ((difference == 0) if valid else (difference != 0)))
+        return analytic_line.join(account,
+            condition=account.id == analytic_line.account
+            ).join(groups,
+            condition=(groups.move_line == analytic_line.move_line)
+            & (groups.root == account.root)
+            ).select(analytic_line.id)
+
+    @classmethod
+    def _revalidation_where(cls, line, move, company=None, from_date=None,
+            to_date=None, accounts=None, periods=None):
+        'Return the SQL clause of the move lines to revalidate'
+        where = Literal(True)
+        if company is not None:
+            where &= move.company == company
+        if from_date is not None:
+            where &= move.date >= from_date
+        if to_date is not None:
+            where &= move.date <= to_date
+        if accounts is not None:
+            where &= line.account.in_(accounts or [-1])
+        if periods is not None:
+            where &= move.period.in_(periods or [-1])
+        return where
+
+    @classmethod
+    def revalidate_analytic_lines(cls, company=None, from_date=None,
+            to_date=None, accounts=None, periods=None, start=None, end=None,
+            chunk=None, commit=True):
+        '''
+        Recompute the analytic balances and states of the move lines filtered
+        by company, move date, account ids and period ids by chunks of move
+        lines.
+
+        The move lines are processed by increasing id, starting after the
+        start id up to the end id, and each chunk is committed if commit is
+        set.
+        An interrupted run is resumed by passing the last id that was logged
+        as start.
+        Return the id of the last processed move line.
+        '''
+        pool = Pool()
+        AnalyticLine = pool.get('analytic_account.line')
+        Balance = pool.get('analytic_account.line.balance')
+        Move = pool.get('account.move')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        line = cls.__table__()
+        move = Move.__table__()
+
+        if chunk is None:
+            chunk = transaction.database.IN_MAX
+        where = cls._revalidation_where(line, move, company=company,
+            from_date=from_date, to_date=to_date, accounts=accounts,
+            periods=periods)
+        if end is not None:
+            where &= line.id <= end
+        query = line.join(move, condition=move.id == line.move)
+
+        last_id = start or 0
+        cursor.execute(*query.select(Count(Literal('*')),
+                where=where & (line.id > last_id)))
+        total, = cursor.fetchone()
+        done = 0
+        while True:
+            cursor.execute(*query.select(line.id,
+                    where=where & (line.id > last_id),
+                    order_by=line.id.asc,
+                    limit=chunk))
+            ids = [i for i, in cursor]
+            if not ids:
+                break
+            Balance._fill(ids)
+            AnalyticLine._set_state('draft',
+                cls._analytic_lines_query(ids, False))
+            AnalyticLine._set_state('valid',
+                cls._analytic_lines_query(ids, True))
+            if commit:
+                transaction.commit()
+            last_id = ids[-1]
+            done += len(ids)
+            logger.info('revalidated analytic lines of %s/%s move lines '
+                '(last id %s)', done, total, last_id)
+        return last_id
 
-        todraft, tovalid = [], []
+    @classmethod
+    def enqueue_revalidate_analytic_lines(cls, company=None, from_date=None,
+            to_date=None, accounts=None, size=None):
+        '''
+        Split the revalidation of the analytic lines by period and by id
+        ranges of at most size move lines and push a queue task for each
+        partition.
+        The partitions do not overlap so the tasks can run in parallel.
+        The periods whose analytic line totals are kept are not split as all
+        their partitions would update the same totals.
+        Return the ids of the queue tasks.
+        '''
+        pool = Pool()
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
+        Total = pool.get('analytic_account.line.total')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        line = cls.__table__()
+        move = Move.__table__()
+        period = Period.__table__()
+
+        if size is None:
+            size = 10 * transaction.database.IN_MAX
+        where = cls._revalidation_where(line, move, company=company,
+            from_date=from_date, to_date=to_date, accounts=accounts)
+        query = line.join(move, condition=move.id == line.move)
+
+        cursor.execute(*query.join(period,
+                condition=period.id == move.period
+                ).select(period.id, period.state,
+                where=where,
+                group_by=[period.id, period.state],
+                order_by=period.id))
+        periods = list(cursor)
+
+        task_ids = []
+        for period_id, state in periods:
+            if state in Total._closed_states():
+                task_ids.extend(Period.__queue__.revalidate_analytic_lines(
+                        [Period(period_id)], from_date=from_date,
+                        to_date=to_date, accounts=accounts))
+                continue
+            period_where = where & (move.period == period_id)
+            start = None
+            while True:
+                cursor.execute(*query.select(line.id,
+                        where=period_where & (line.id > (start or 0)),
+                        order_by=line.id.asc,
+                        limit=1, offset=size - 1))
+                row = cursor.fetchone()
+                end = row[0] if row else None
+                if end is None:
+                    # Check if there are remaining lines for a last partition
+                    cursor.execute(*query.select(line.id,
+                            where=period_where & (line.id > (start or 0)),
+                            limit=1))
+                    if not cursor.fetchone():
+                        break
+                task_ids.extend(Period.__queue__.revalidate_analytic_lines(
+                        [Period(period_id)], from_date=from_date,
+                        to_date=to_date, accounts=accounts,
+                        start=start, end=end))
+                if end is None:
+                    break
+                start = end
+        return task_ids
+
+    @classmethod
+    def analytic_rule_matcher(cls):
+        'Return the analytic rule matcher of the transaction for the company'
+        transaction = Transaction()
+        matchers = _rule_matchers.setdefault(transaction, {})
+        company = transaction.context.get('company')
+        matcher = matchers.get(company)
+        if matcher is None:
+            Rule = Pool().get('analytic_account.rule')
+            matcher = matchers[company] = AnalyticRuleMatcher(Rule.search([]))
+        return matcher
+
+    @staticmethod
+    def _clear_analytic_rule_matcher():
+        _rule_matchers.pop(Transaction(), None)
+
+    @classmethod
+    @instrumented('account.move.line.apply_rule')
+    def apply_rule(cls, lines):
+        '''
+        Set the analytic lines of the lines from the first matching rule with
+        the state they will be validated to.
+        Only the lines matched by the analytic rule matcher are applied the
+        rules.
+        '''
+        matcher = cls.analytic_rule_matcher()
+        lines = [l for l, must_have_analytic in zip(lines,
+                cls.lines_must_have_analytic(lines))
+            if must_have_analytic
+            and not l.analytic_lines
+            and matcher.match(l.rule_pattern)]
+        super(MoveLine, cls).apply_rule(lines)
+        cls.preset_analytic_lines_state([l for l in lines if l.analytic_lines])
+
+    @classmethod
+    def preset_analytic_lines_state(cls, lines):
+        '''
+        Set on the analytic lines of the unsaved lines the state they will be
+        validated to.
+        '''
+        AnalyticAccount = Pool().get('analytic_account.account')
+
+        roots = AnalyticAccount.get_roots(list({
+                    a.account.id for l in lines for a in l.analytic_lines}))
         for line in lines:
-            analytic_lines_by_root = {}
+            amount = (line.debit or 0) - (line.credit or 0)
+            balances = {}
+            for analytic_line in line.analytic_lines:
+                root = roots.get(analytic_line.account.id)
+                balances[root] = balances.get(root, 0) + (
+                    analytic_line.debit - analytic_line.credit)
             for analytic_line in line.analytic_lines:
-                analytic_lines_by_root.setdefault(analytic_line.account.root,
-                    []).append(analytic_line)
-
-            line_balance = line.debit - line.credit
-            for analytic_lines in analytic_lines_by_root.values():
-                balance = sum((al.debit - al.credit) for al in analytic_lines)
-                if balance == line_balance:
-                    tovalid += [al for al in analytic_lines
-                        if al.state != 'valid']
+                root = roots.get(analytic_line.account.id)
+                if root is not None and balances[root] == amount:
+                    analytic_line.state = 'valid'
                 else:
-                    todraft += [al for al in analytic_lines
-                        if al.state != 'draft']
-        if todraft:
-            AnalyticLine.write(todraft, {
-                    'state': 'draft',
-                    })
-        if tovalid:
-            AnalyticLine.write(tovalid, {
-                    'state': 'valid',
-                    })
+                    analytic_line.state = 'draft'
 
     @classmethod
-    def create(cls, vlist):
-        lines = super(MoveLine, cls).create(vlist)
-        cls.validate_analytic_lines(lines)
-        return lines
+    def _analytic_validation_fields(cls):
+        'Return the fields whose write can change the analytic lines state'
+        return {'debit', 'credit', 'account', 'analytic_lines'}
 
     @classmethod
     def write(cls, *args):
         super(MoveLine, cls).write(*args)
-        lines = list(chain(*args[::2]))
-        cls.validate_analytic_lines(lines)
+        fields = cls._analytic_validation_fields()
+        lines = []
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if fields.intersection(values):
+                lines.extend(records)
+        if lines:
+            cls.validate_analytic_lines(lines)
 
     @classmethod
     def delete(cls, lines):
-        AnalyticLine = Pool().get('analytic_account.line')
-        todraft_lines = [al for line in lines for al in line.analytic_lines]
-        AnalyticLine.write(todraft_lines, {
-                'state': 'draft',
-                })
-
-        from_statement = Transaction().context.get(
+        pool = Pool()
+        AnalyticLine = pool.get('analytic_account.line')
+        Move = pool.get('account.move')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        move = Move.__table__()
+        analytic_line = AnalyticLine.__table__()
+
+        ids = [l.id for l in lines]
+        from_statement = transaction.context.get(
             'from_account_bank_statement_line', False)
         if not from_statement:
-            for line in lines:
-                if line.move.state == 'posted':
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.join(move,
+                        condition=move.id == table.move
+                        ).select(table.id,
+                        where=reduce_ids(table.id, sub_ids)
+                        & (move.state == 'posted'),
+                        limit=1))
+                row = cursor.fetchone()
+                if row:
+                    line = cls(row[0])
                     raise AccessError(gettext(
                         'account.msg_modify_line_posted_move',
                             line=line.rec_name,
                             move=line.move.rec_name,
                             ))
-        super(MoveLine, cls).delete(lines)
+
+        for sub_ids in grouped_slice(ids):
+            AnalyticLine._set_state('draft', analytic_line.select(
+                    analytic_line.id,
+                    where=reduce_ids(analytic_line.move_line, sub_ids)))
+
+        # The analytic lines deleted in cascade must not revalidate the move
+        # lines being deleted
+        with transaction.set_context(_skip_analytic_validation=True):
+            super(MoveLine, cls).delete(lines)
 
     @dualmethod
     def save(cls, lines):
@@ -291,18 +912,38 @@ class MoveLine(metaclass=PoolMeta):
         return have_analytic
 
     def _must_have_analytic(line):
-        # this code is a copy from @property must_have_analytic() method from analytic_account module
-        pool = Pool()
-        FiscalYear = pool.get('account.fiscalyear')
+        must_have_analytic, = line.lines_must_have_analytic([line])
+        return must_have_analytic
 
-        if line.account.analytic_required:
-            return True
-        if line.account.type:
-            return line.account.type.statement == 'income' and not (
-                # ignore balance move of non-deferral account
-                hasattr(line, 'journal') and line.journal.type == 'situation'
-                and hasattr(line, 'period') and line.period.type == 'adjustment'
-                and hasattr(line.move, 'origin') and isinstance(line.move.origin, FiscalYear))
+    @classmethod
+    def lines_must_have_analytic(cls, lines):
+        '''
+        Return for each line if it must have analytic lines.
+        must_have_analytic is memoized for the transaction by the
+        _must_have_analytic_key of the lines.
+        '''
+        memo = _must_have_analytic_cache.setdefault(Transaction(), {})
+        result = []
+        for line in lines:
+            key = line._must_have_analytic_key()
+            if key not in memo:
+                memo[key] = line.must_have_analytic
+            result.append(memo[key])
+        return result
+
+    def _must_have_analytic_key(self):
+        '''
+        Return the key of the values on which must_have_analytic depends:
+        (account, journal type, period type, origin is a fiscal year)
+        It must be extended with the values read by the extensions of
+        must_have_analytic.
+        '''
+        FiscalYear = Pool().get('account.fiscalyear')
+        return (
+            self.account.id,
+            self.journal.type,
+            self.period.type,
+            isinstance(self.move.origin, FiscalYear))
 
     @classmethod
     def _get_writeoff_move(
@@ -311,9 +952,7 @@ class MoveLine(metaclass=PoolMeta):
         move = super()._get_writeoff_move(reconcile_account, reconcile_party,
             amount, currency, writeoff, date, description)
 
-        # Set analytic accounts from analytic rules.
-        # When create() move.line, called set_analytic_state()
-        # that set analytic lines
+        # Set analytic accounts from analytic rules before the move is saved
         move._set_analytic_account_from_rule()
 
         return move
@@ -322,9 +961,26 @@ class MoveLine(metaclass=PoolMeta):
     def _get_exchange_move(cls, account, party, amount, date=None):
         move = super()._get_exchange_move(account, party, amount, date)
 
-        # Set analytic accounts from analytic rules.
-        # When create() move.line, called set_analytic_state()
-        # that set analytic lines
+        # Set analytic accounts from analytic rules before the move is saved
         move._set_analytic_account_from_rule()
 
         return move
+
+    @classmethod
+    @instrumented('account.move.line.reconcile')
+    def reconcile(
+            cls, *lines_list, date=None, writeoff=None, description=None,
+            delegate_to=None):
+        '''
+        Validate the analytic lines of the write-off and exchange moves of all
+        the lists of lines at once.
+        '''
+        transaction = Transaction()
+        deferred = transaction.context.get('defer_analytic_validation')
+        with transaction.set_context(defer_analytic_validation=True):
+            reconciliations = super().reconcile(*lines_list, date=date,
+                writeoff=writeoff, description=description,
+                delegate_to=delegate_to)
+        if not deferred:
+            transaction.join(AnalyticValidationDataManager()).validate()
+        return reconciliations
@@ -1,16 +1,26 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from sql import Column
-from sql.aggregate import Sum
-from sql.conditionals import Coalesce
+from array import array
+from bisect import bisect_left
 
-from trytond.model import ModelSQL, fields
+from sql import Column, Literal, Null, Union
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Coalesce, Greatest, Least
+from sql.functions import CurrentTimestamp
+from sql.operators import Exists
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.model import Index, ModelSQL, Unique, fields, dualmethod
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Or
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 from trytond.i18n import gettext
 from trytond.model.exceptions import ValidationError
 
+from .instrumentation import instrumented
+
 
 class AnalyticAccount(metaclass=PoolMeta):
     __name__ = 'analytic_account.account'
@@ -49,7 +59,8 @@ class AnalyticAccount(metaclass=PoolMeta):
             'account.account', None, None, 'Pending Accounts', states={
                 'invisible': Eval('type') != 'root',
                 }),
-        'on_change_with_analytic_pending_accounts')
+        'get_analytic_pending_accounts')
+    _root_cache = Cache(__name__ + '.root', context=False)
 
     @fields.depends('analytic_required', 'analytic_forbidden',
         'analytic_optional', 'company')
@@ -66,35 +77,251 @@ class AnalyticAccount(metaclass=PoolMeta):
                 ])
         return [x.id for x in pending_accounts]
 
+    @classmethod
+    def get_analytic_pending_accounts(cls, accounts, name):
+        '''
+        Return the active accounts with a type of the company of each
+        analytic account that are not configured:
+        {analytic_account_id: [account_id]}
+        '''
+        Account = Pool().get('account.account')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        account = Account.__table__()
+
+        result = {a.id: [] for a in accounts}
+        query = table.join(account,
+            condition=account.company == table.company)
+        active = Account.domain_active(
+            ('active', '=', True), {None: (account, None)})
+        for sub_ids in grouped_slice(result.keys()):
+            cursor.execute(*query.select(table.id, account.id,
+                    where=reduce_ids(table.id, sub_ids)
+                    & (account.type != Null)
+                    & active
+                    & ~Account._analytic_configured(account, table),
+                    order_by=[table.id, account.id]))
+            for analytic_account, account_id in cursor:
+                result[analytic_account].append(account_id)
+        return result
+
     @classmethod
     def query_get(cls, ids, names):
+        '''
+        Return the query of the amounts of the analytic accounts.
+        The amounts of the closed periods are read from the analytic line
+        totals and only the analytic lines of the open periods are scanned,
+        unless the totals can not answer the filters of the lines.
+        '''
         pool = Pool()
         Line = pool.get('analytic_account.line')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Period = pool.get('account.period')
+        Total = pool.get('analytic_account.line.total')
+        context = Transaction().context
+        closed = Total._closed_states()
+
+        start_date = context.get('start_date')
+        end_date = context.get('end_date')
+
+        def covered(total):
+            'All the lines of the total are inside the dates of the context'
+            clause = Literal(True)
+            if start_date:
+                clause &= total.first_date >= start_date
+            if end_date:
+                clause &= total.last_date <= end_date
+            return clause
+
+        def lines_amounts(line, query, where):
+            return query.select(line.account,
+                line.internal_company.as_('company'),
+                line.debit, line.credit,
+                where=where & line.account.in_(ids) & Line.query_get(line))
+
+        if not Total.match_query_get():
+            # The totals can not answer the filters of the lines
+            line = Line.__table__()
+            return cls._amounts_query(ids, names,
+                lines_amounts(line, line, Literal(True)), True)
+
+        # The totals of the closed periods inside the dates
+        total = Total.__table__()
+        period = Period.__table__()
+        queries = [total.join(period, condition=period.id == total.period
+                ).select(total.account, total.company,
+                total.debit, total.credit,
+                where=period.state.in_(closed)
+                & total.account.in_(ids)
+                & covered(total) & Line.query_get_state(total))]
+
+        # The lines of the open periods
+        line = Line.__table__()
+        move_line = MoveLine.__table__()
+        move = Move.__table__()
+        period = Period.__table__()
+        queries.append(lines_amounts(line, line.join(move_line,
+                    condition=move_line.id == line.move_line
+                    ).join(move, condition=move.id == move_line.move
+                    ).join(period, condition=period.id == move.period),
+                ~period.state.in_(closed)))
+
+        # The lines without move line
+        line = Line.__table__()
+        queries.append(lines_amounts(line, line, line.move_line == Null))
+
+        # The lines of the closed periods with totals partially inside the
+        # dates
+        if start_date or end_date:
+            total = Total.__table__()
+            period = Period.__table__()
+            line = Line.__table__()
+            move_line = MoveLine.__table__()
+            move = Move.__table__()
+            queries.append(lines_amounts(line, total.join(period,
+                        condition=period.id == total.period
+                        ).join(line,
+                        condition=(line.account == total.account)
+                        & (line.state == total.state)
+                        & (line.internal_company == total.company)
+                        ).join(move_line,
+                        condition=move_line.id == line.move_line
+                        ).join(move,
+                        condition=(move.id == move_line.move)
+                        & (move.period == total.period)),
+                    period.state.in_(closed) & ~covered(total)))
+        return cls._amounts_query(ids, names, Union(*queries, all_=True),
+            bool(start_date or end_date or context.get('posted')))
+
+    @classmethod
+    def _amounts_query(cls, ids, names, amounts, filtered):
+        '''
+        Return the query of the amounts of the analytic accounts summed from
+        the amounts query with account, company, debit and credit columns.
+        '''
+        pool = Pool()
         Company = pool.get('company.company')
         table = cls.__table__()
-        line = Line.__table__()
         company = Company.__table__()
 
-        line_query = Line.query_get(line)
-
         columns = [table.id, company.currency]
         for name in names:
             if name == 'balance':
-                columns.append(
-                    Sum(Coalesce(line.debit, 0) - Coalesce(line.credit, 0)))
+                columns.append(Sum(Coalesce(amounts.debit, 0)
+                        - Coalesce(amounts.credit, 0)))
             else:
-                columns.append(Sum(Coalesce(Column(line, name), 0)))
-        query = table.join(line, 'LEFT',
-            condition=table.id == line.account
+                columns.append(Sum(Coalesce(Column(amounts, name), 0)))
+        where = (table.type != 'view') & table.id.in_(ids) & table.active
+        if filtered:
+            # Like the filtered lines, the accounts without line are excluded
+            where &= amounts.account != Null
+        query = table.join(amounts, 'LEFT',
+            condition=table.id == amounts.account
             ).join(company, 'LEFT',
-            condition=company.id == line.internal_company
+            condition=company.id == amounts.company
             ).select(*columns,
-            where=(table.type != 'view')
-            & table.id.in_(ids)
-            & table.active & line_query,
+            where=where,
             group_by=(table.id, company.currency))
         return query
 
+    @classmethod
+    def _company_roots(cls, company_id):
+        '''
+        Return the ids of the analytic accounts of the company with a root and
+        the ids of their root as two parallel arrays sorted by account id.
+        '''
+        roots = cls._root_cache.get(company_id)
+        if roots is not None:
+            return roots
+
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        cursor.execute(*table.select(table.id, table.root,
+                where=(table.company == company_id) & (table.root != Null),
+                order_by=table.id))
+        account_ids, root_ids = array('q'), array('q')
+        for account_id, root_id in cursor:
+            account_ids.append(account_id)
+            root_ids.append(root_id)
+        return cls._root_cache.set(company_id, (account_ids, root_ids))
+
+    @classmethod
+    def get_roots(cls, ids):
+        '''
+        Return a dictionary with the root id of each analytic account id:
+        {account_id: root_id}
+        Accounts without root are not included.
+        '''
+        company_id = Transaction().context.get('company')
+        if company_id is not None:
+            account_ids, root_ids = cls._company_roots(company_id)
+        else:
+            account_ids, root_ids = array('q'), array('q')
+
+        roots, missing = {}, []
+        for id_ in ids:
+            i = bisect_left(account_ids, id_)
+            if i < len(account_ids) and account_ids[i] == id_:
+                roots[id_] = root_ids[i]
+            else:
+                missing.append(id_)
+
+        # The accounts of other companies are read from the database
+        if missing:
+            cursor = Transaction().connection.cursor()
+            table = cls.__table__()
+            for sub_ids in grouped_slice(missing):
+                cursor.execute(*table.select(table.id, table.root,
+                        where=reduce_ids(table.id, sub_ids)
+                        & (table.root != Null)))
+                roots.update(cursor)
+        return roots
+
+    @classmethod
+    def _clear_analytic_cache(cls):
+        Account = Pool().get('account.account')
+        Account._clear_analytic_cache()
+        cls._root_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        accounts = super(AnalyticAccount, cls).create(vlist)
+        cls._clear_analytic_cache()
+        return accounts
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Balance = pool.get('analytic_account.line.balance')
+        Line = pool.get('analytic_account.line')
+        cursor = Transaction().connection.cursor()
+        line = Line.__table__()
+
+        actions = iter(args)
+        root_ids = []
+        for accounts, values in zip(actions, actions):
+            if 'root' in values:
+                root_ids.extend(a.id for a in accounts)
+        super(AnalyticAccount, cls).write(*args)
+        cls._clear_analytic_cache()
+
+        # The balances are kept by root
+        move_line_ids = set()
+        for sub_ids in grouped_slice(root_ids):
+            cursor.execute(*line.select(line.move_line,
+                    where=reduce_ids(line.account, sub_ids)
+                    & (line.move_line != Null),
+                    group_by=line.move_line))
+            move_line_ids.update(r for r, in cursor)
+        if move_line_ids:
+            Balance._fill(sorted(move_line_ids))
+
+    @classmethod
+    def delete(cls, accounts):
+        super(AnalyticAccount, cls).delete(accounts)
+        cls._clear_analytic_cache()
+
     @classmethod
     def validate(cls, accounts):
         super(AnalyticAccount, cls).validate(accounts)
@@ -128,7 +355,36 @@ class AnalyticAccount(metaclass=PoolMeta):
                     ))
 
 
-class AnalyticAccountAccountRequired(ModelSQL):
+class AnalyticConstraintMixin(object):
+    '''
+    Clear the cached analytic configuration of the accounts when the
+    relation between accounts and analytic roots changes.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def _clear_analytic_cache(cls):
+        Account = Pool().get('account.account')
+        Account._clear_analytic_cache()
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        cls._clear_analytic_cache()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._clear_analytic_cache()
+
+    @classmethod
+    def delete(cls, records):
+        super().delete(records)
+        cls._clear_analytic_cache()
+
+
+class AnalyticAccountAccountRequired(AnalyticConstraintMixin, ModelSQL):
     'Analytic Account - Account - Required'
     __name__ = 'analytic_account.account-required-account.account'
     _table = 'analytic_acc_acc_required_acc_acc'
@@ -139,7 +395,7 @@ class AnalyticAccountAccountRequired(ModelSQL):
         ondelete='CASCADE', required=True)
 
 
-class AnalyticAccountAccountForbidden(ModelSQL):
+class AnalyticAccountAccountForbidden(AnalyticConstraintMixin, ModelSQL):
     'Analytic Account - Account - Forbidden'
     __name__ = 'analytic_account.account-forbidden-account.account'
     _table = 'analytic_acc_acc_forbidden_acc_acc'
@@ -150,7 +406,7 @@ class AnalyticAccountAccountForbidden(ModelSQL):
         ondelete='CASCADE', required=True)
 
 
-class AnalyticAccountAccountOptional(ModelSQL):
+class AnalyticAccountAccountOptional(AnalyticConstraintMixin, ModelSQL):
     'Analytic Account - Account - Optional'
     __name__ = 'analytic_account.account-optional-account.account'
     _table = 'analytic_acc_acc_optional_acc_acc'
@@ -161,6 +417,374 @@ class AnalyticAccountAccountOptional(ModelSQL):
         ondelete='CASCADE', required=True)
 
 
+class AnalyticRule(metaclass=PoolMeta):
+    __name__ = 'analytic_account.rule'
+
+    @classmethod
+    def _clear_analytic_rule_matcher(cls):
+        MoveLine = Pool().get('account.move.line')
+        MoveLine._clear_analytic_rule_matcher()
+
+    @classmethod
+    def create(cls, vlist):
+        rules = super().create(vlist)
+        cls._clear_analytic_rule_matcher()
+        return rules
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._clear_analytic_rule_matcher()
+
+    @classmethod
+    def delete(cls, rules):
+        super().delete(rules)
+        cls._clear_analytic_rule_matcher()
+
+
+class AnalyticLineBalance(ModelSQL):
+    'Analytic Line Balance'
+    __name__ = 'analytic_account.line.balance'
+    move_line = fields.Many2One('account.move.line', 'Move Line',
+        required=True, ondelete='CASCADE')
+    root = fields.Many2One('analytic_account.account', 'Root',
+        required=True, ondelete='CASCADE')
+    balance = fields.Numeric('Balance', required=True)
+    line_count = fields.Integer('Line Count', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(AnalyticLineBalance, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('move_line_root_uniq', Unique(t, t.move_line, t.root),
+                'analytic_line_state.msg_analytic_line_balance_unique'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        exist = backend.TableHandler.table_exist(cls._table)
+        super(AnalyticLineBalance, cls).__register__(module_name)
+        if not exist:
+            cls._fill()
+
+    @classmethod
+    def _fill(cls, move_line_ids=None):
+        '''
+        Compute the balances of all the analytic lines or only of the analytic
+        lines of the move line ids replacing their current balances.
+        '''
+        pool = Pool()
+        AnalyticAccount = pool.get('analytic_account.account')
+        AnalyticLine = pool.get('analytic_account.line')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        line = AnalyticLine.__table__()
+        account = AnalyticAccount.__table__()
+
+        if move_line_ids is None:
+            wheres = [Literal(True)]
+        else:
+            wheres = []
+            for sub_ids in grouped_slice(move_line_ids):
+                sub_ids = list(sub_ids)
+                cursor.execute(*table.delete(
+                        where=reduce_ids(table.move_line, sub_ids)))
+                wheres.append(reduce_ids(line.move_line, sub_ids))
+
+        for where in wheres:
+            cursor.execute(*table.insert([table.move_line, table.root,
+                        table.balance, table.line_count,
+                        table.create_uid, table.create_date],
+                    line.join(account, condition=account.id == line.account
+                        ).select(line.move_line, account.root,
+                        Sum(line.debit - line.credit), Count(Literal('*')),
+                        Literal(transaction.user), CurrentTimestamp(),
+                        where=where & (line.move_line != Null)
+                        & (account.root != Null),
+                        group_by=[line.move_line, account.root])))
+
+    @classmethod
+    def add_lines(cls, line_ids):
+        'Add the amounts of the analytic lines to the balances'
+        cls._update_lines(line_ids, 1)
+
+    @classmethod
+    def remove_lines(cls, line_ids):
+        'Remove the amounts of the analytic lines from the balances'
+        cls._update_lines(line_ids, -1)
+
+    @classmethod
+    def _update_lines(cls, line_ids, sign):
+        pool = Pool()
+        AnalyticAccount = pool.get('analytic_account.account')
+        AnalyticLine = pool.get('analytic_account.line')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        def lines_query(sub_ids):
+            line = AnalyticLine.__table__()
+            account = AnalyticAccount.__table__()
+            return line, account, line.join(account,
+                condition=account.id == line.account), (
+                reduce_ids(line.id, sub_ids) & (line.move_line != Null)
+                & (account.root != Null))
+
+        for sub_ids in grouped_slice(line_ids):
+            sub_ids = list(sub_ids)
+
+            if sign > 0:
+                line, account, query, where = lines_query(sub_ids)
+                existing = cls.__table__()
+                cursor.execute(*table.insert([table.move_line, table.root,
+                            table.balance, table.line_count,
+                            table.create_uid, table.create_date],
+                        query.select(line.move_line, account.root,
+                            Literal(0), Literal(0),
+                            Literal(transaction.user), CurrentTimestamp(),
+                            where=where & ~Exists(existing.select(
+                                    existing.id,
+                                    where=(existing.move_line
+                                        == line.move_line)
+                                    & (existing.root == account.root))),
+                            group_by=[line.move_line, account.root])))
+
+            line, account, query, where = lines_query(sub_ids)
+            where &= ((line.move_line == table.move_line)
+                & (account.root == table.root))
+            amount = query.select(Sum(line.debit - line.credit), where=where)
+            count = query.select(Count(Literal('*')), where=where)
+            if sign > 0:
+                values = [table.balance + amount, table.line_count + count]
+            else:
+                values = [table.balance - amount, table.line_count - count]
+            cursor.execute(*table.update(
+                    [table.balance, table.line_count,
+                        table.write_uid, table.write_date],
+                    values + [transaction.user, CurrentTimestamp()],
+                    where=Exists(query.select(line.id, where=where))))
+
+            if sign < 0:
+                line = AnalyticLine.__table__()
+                cursor.execute(*table.delete(
+                        where=(table.line_count <= 0)
+                        & table.move_line.in_(line.select(line.move_line,
+                                where=reduce_ids(line.id, sub_ids)))))
+
+
+class AnalyticLineTotal(ModelSQL):
+    'Analytic Line Total'
+    __name__ = 'analytic_account.line.total'
+    account = fields.Many2One('analytic_account.account', 'Account',
+        required=True, ondelete='CASCADE')
+    period = fields.Many2One('account.period', 'Period', required=True,
+        ondelete='CASCADE')
+    state = fields.Char('State', required=True)
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE')
+    debit = fields.Numeric('Debit', required=True)
+    credit = fields.Numeric('Credit', required=True)
+    line_count = fields.Integer('Line Count', required=True)
+    first_date = fields.Date('First Date', required=True)
+    last_date = fields.Date('Last Date', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(AnalyticLineTotal, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('account_period_state_company_uniq',
+                Unique(t, t.account, t.period, t.state, t.company),
+                'analytic_line_state.msg_analytic_line_total_unique'),
+            ]
+        cls._sql_indexes.add(
+            Index(t, (t.period, Index.Range()), (t.account, Index.Range())))
+
+    @classmethod
+    def __register__(cls, module_name):
+        exist = backend.TableHandler.table_exist(cls._table)
+        super(AnalyticLineTotal, cls).__register__(module_name)
+        if not exist:
+            cls._fill()
+
+    @staticmethod
+    def _closed_states():
+        'Return the states of the periods whose totals are kept'
+        return ['closed', 'locked']
+
+    @classmethod
+    def _fill(cls, period_ids=None):
+        '''
+        Compute the totals of all the closed periods or only of the period ids
+        replacing their current totals.
+        '''
+        pool = Pool()
+        AnalyticLine = pool.get('analytic_account.line')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Period = pool.get('account.period')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        line = AnalyticLine.__table__()
+        move_line = MoveLine.__table__()
+        move = Move.__table__()
+        period = Period.__table__()
+
+        if period_ids is None:
+            cursor.execute(*period.select(period.id,
+                    where=period.state.in_(cls._closed_states())))
+            period_ids = [p for p, in cursor]
+        else:
+            cls._clear(period_ids)
+
+        for sub_ids in grouped_slice(period_ids):
+            cursor.execute(*table.insert([table.account, table.period,
+                        table.state, table.company, table.debit,
+                        table.credit, table.line_count, table.first_date,
+                        table.last_date, table.create_uid, table.create_date],
+                    line.join(move_line,
+                        condition=move_line.id == line.move_line
+                        ).join(move, condition=move.id == move_line.move
+                        ).select(line.account, move.period, line.state,
+                        line.internal_company, Sum(line.debit),
+                        Sum(line.credit), Count(Literal('*')),
+                        Min(line.date), Max(line.date),
+                        Literal(transaction.user), CurrentTimestamp(),
+                        where=reduce_ids(move.period, sub_ids),
+                        group_by=[line.account, move.period, line.state,
+                            line.internal_company])))
+
+    @classmethod
+    def _clear(cls, period_ids):
+        'Remove the totals of the period ids'
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        for sub_ids in grouped_slice(period_ids):
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.period, sub_ids)))
+
+    @classmethod
+    def match_query_get(cls):
+        '''
+        Return if the clause of AnalyticLine.query_get for the context only
+        filters on the dates and the state that the totals can answer.
+        '''
+        pool = Pool()
+        AnalyticLine = pool.get('analytic_account.line')
+        context = Transaction().context
+        line = AnalyticLine.__table__()
+
+        clause = Literal(True)
+        if context.get('start_date'):
+            clause &= line.date >= context['start_date']
+        if context.get('end_date'):
+            clause &= line.date <= context['end_date']
+        clause &= AnalyticLine.query_get_state(line)
+        query_get = AnalyticLine.query_get(line)
+        return (str(query_get) == str(clause)
+            and tuple(query_get.params) == tuple(clause.params))
+
+    @classmethod
+    def add_lines(cls, line_ids):
+        'Add the amounts of the analytic lines of closed periods to the totals'
+        cls._update_lines(line_ids, 1)
+
+    @classmethod
+    def remove_lines(cls, line_ids):
+        '''
+        Remove the amounts of the analytic lines of closed periods from the
+        totals
+        '''
+        cls._update_lines(line_ids, -1)
+
+    @classmethod
+    def _update_lines(cls, line_ids, sign):
+        pool = Pool()
+        AnalyticLine = pool.get('analytic_account.line')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Period = pool.get('account.period')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        def lines_query(sub_ids):
+            line = AnalyticLine.__table__()
+            move_line = MoveLine.__table__()
+            move = Move.__table__()
+            period = Period.__table__()
+            return line, move, line.join(move_line,
+                condition=move_line.id == line.move_line
+                ).join(move, condition=move.id == move_line.move
+                ).join(period, condition=period.id == move.period), (
+                reduce_ids(line.id, sub_ids)
+                & period.state.in_(cls._closed_states()))
+
+        for sub_ids in grouped_slice(line_ids):
+            sub_ids = list(sub_ids)
+
+            if sign > 0:
+                line, move, query, where = lines_query(sub_ids)
+                existing = cls.__table__()
+                cursor.execute(*table.insert([table.account, table.period,
+                            table.state, table.company, table.debit,
+                            table.credit, table.line_count, table.first_date,
+                            table.last_date, table.create_uid,
+                            table.create_date],
+                        query.select(line.account, move.period, line.state,
+                            line.internal_company, Literal(0), Literal(0),
+                            Literal(0), Min(line.date), Max(line.date),
+                            Literal(transaction.user), CurrentTimestamp(),
+                            where=where & ~Exists(existing.select(
+                                    existing.id,
+                                    where=(existing.account == line.account)
+                                    & (existing.period == move.period)
+                                    & (existing.state == line.state)
+                                    & (existing.company
+                                        == line.internal_company))),
+                            group_by=[line.account, move.period, line.state,
+                                line.internal_company])))
+
+            line, move, query, where = lines_query(sub_ids)
+            where &= ((line.account == table.account)
+                & (move.period == table.period)
+                & (line.state == table.state)
+                & (line.internal_company == table.company))
+            debit = query.select(Sum(line.debit), where=where)
+            credit = query.select(Sum(line.credit), where=where)
+            count = query.select(Count(Literal('*')), where=where)
+            columns = [table.debit, table.credit, table.line_count]
+            if sign > 0:
+                values = [table.debit + debit, table.credit + credit,
+                    table.line_count + count]
+                # The dates are only widened, the totals partially inside
+                # the dates are completed from the lines
+                columns += [table.first_date, table.last_date]
+                values += [
+                    Least(table.first_date,
+                        query.select(Min(line.date), where=where)),
+                    Greatest(table.last_date,
+                        query.select(Max(line.date), where=where)),
+                    ]
+            else:
+                values = [table.debit - debit, table.credit - credit,
+                    table.line_count - count]
+            cursor.execute(*table.update(
+                    columns + [table.write_uid, table.write_date],
+                    values + [transaction.user, CurrentTimestamp()],
+                    where=Exists(query.select(line.id, where=where))))
+
+            if sign < 0:
+                line = AnalyticLine.__table__()
+                cursor.execute(*table.delete(
+                        where=(table.line_count <= 0)
+                        & table.account.in_(line.select(line.account,
+                                where=reduce_ids(line.id, sub_ids)))))
+
+
 _STATES = {
     'readonly': Eval('state') != 'draft',
     }
@@ -204,6 +828,19 @@ class AnalyticLine(metaclass=PoolMeta):
             }
         cls.move_line.depends |= {'internal_company', 'state'}
 
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.move_line, Index.Range()),
+                    (t.account, Index.Range())),
+                Index(t, (t.internal_company, Index.Range()),
+                    (t.state, Index.Equality(cardinality='low')),
+                    (t.date, Index.Range())),
+                Index(t, (t.account, Index.Range()),
+                    (t.state, Index.Equality(cardinality='low'))),
+                Index(t, (t.account, Index.Range()), (t.date, Index.Range()),
+                    where=t.state == 'valid'),
+                })
+
     @staticmethod
     def default_internal_company():
         return Transaction().context.get('company')
@@ -229,68 +866,174 @@ class AnalyticLine(metaclass=PoolMeta):
         table is the SQL instance of the analytic_account_line table.
         '''
         clause = super(AnalyticLine, cls).query_get(table)
+        return clause & cls.query_get_state(table)
+
+    @classmethod
+    def query_get_state(cls, table):
+        '''
+        Return SQL clause for the state depending of the context.
+        table is the SQL instance of a table with a state column.
+        '''
+        clause = Literal(True)
         if Transaction().context.get('posted'):
-            clause &= table.state == 'posted'
+            clause &= table.state == 'valid'
         return clause
 
+    @classmethod
+    def _set_state(cls, state, ids_query):
+        '''
+        Set state of the lines whose id is returned by ids_query.
+        It does not revalidate the move lines so it must only be used to flip
+        the state.
+        '''
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Period = pool.get('account.period')
+        Total = pool.get('analytic_account.line.total')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        move_line = MoveLine.__table__()
+        move = Move.__table__()
+        period = Period.__table__()
+
+        cursor.execute(*table.join(move_line, 'LEFT',
+                condition=move_line.id == table.move_line
+                ).join(move, 'LEFT', condition=move.id == move_line.move
+                ).join(period, 'LEFT', condition=period.id == move.period
+                ).select(table.id, period.state,
+                where=table.id.in_(ids_query) & (table.state != state)))
+        ids, closed_ids = [], []
+        for id_, period_state in cursor:
+            ids.append(id_)
+            if period_state in Total._closed_states():
+                closed_ids.append(id_)
+        if not ids:
+            return
+
+        # Only the totals of the closed periods are kept
+        if closed_ids:
+            Total.remove_lines(closed_ids)
+        # Call super to not revalidate the move lines
+        super(AnalyticLine, cls).write(cls.browse(ids), {
+                'state': state,
+                })
+        if closed_ids:
+            Total.add_lines(closed_ids)
+
     @classmethod
     def validate(cls, lines):
         super(AnalyticLine, cls).validate(lines)
-        for line in lines:
-            line.check_account_forbidden_analytic()
+        cls.check_account_forbidden_analytic(lines)
 
-    def check_account_forbidden_analytic(self):
-        if (self.move_line and
-                self.move_line.account.analytic_constraint(self.account)
-                == 'forbidden'):
-            raise ValidationError(gettext(
-                'analytic_line_state.move_line_account_analytic_forbidden',
-                    line=self.rec_name,
-                    account=self.move_line.account.rec_name,
-                    ))
+    @dualmethod
+    def check_account_forbidden_analytic(cls, lines):
+        pool = Pool()
+        Account = pool.get('account.account')
+        AnalyticAccount = pool.get('analytic_account.account')
+        Forbidden = pool.get(
+            'analytic_account.account-forbidden-account.account')
+        MoveLine = pool.get('account.move.line')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        analytic_account = AnalyticAccount.__table__()
+        move_line = MoveLine.__table__()
+        forbidden = Forbidden.__table__()
+
+        # {account_id: [line_id]}
+        forbidden_lines = {}
+        for sub_ids in grouped_slice([l.id for l in lines]):
+            cursor.execute(*table.join(analytic_account,
+                    condition=analytic_account.id == table.account
+                    ).join(move_line,
+                    condition=move_line.id == table.move_line
+                    ).join(forbidden,
+                    condition=(forbidden.account == move_line.account)
+                    & (forbidden.analytic_account == analytic_account.root)
+                    ).select(move_line.account, table.id,
+                    where=reduce_ids(table.id, sub_ids),
+                    order_by=[move_line.account, table.id]))
+            for account_id, line_id in cursor:
+                forbidden_lines.setdefault(account_id, []).append(line_id)
+        if forbidden_lines:
+            raise ValidationError('\n'.join(gettext(
+                        'analytic_line_state'
+                        '.move_line_account_analytic_forbidden',
+                        line=', '.join(l.rec_name
+                            for l in cls.browse(line_ids)),
+                        account=Account(account_id).rec_name)
+                    for account_id, line_ids in forbidden_lines.items()))
 
     @classmethod
     def create(cls, vlist):
-        MoveLine = Pool().get('account.move.line')
+        pool = Pool()
+        Balance = pool.get('analytic_account.line.balance')
+        MoveLine = pool.get('account.move.line')
+        Total = pool.get('analytic_account.line.total')
 
         lines = super(AnalyticLine, cls).create(vlist)
+        Balance.add_lines([l.id for l in lines])
+        Total.add_lines([l.id for l in lines])
 
         move_lines = list(set(l.move_line for l in lines if l.move_line))
         MoveLine.validate_analytic_lines(move_lines)
         return lines
 
     @classmethod
+    @instrumented('analytic_account.line.write')
     def write(cls, *args):
-        MoveLine = Pool().get('account.move.line')
+        pool = Pool()
+        Balance = pool.get('analytic_account.line.balance')
+        MoveLine = pool.get('account.move.line')
+        Total = pool.get('analytic_account.line.total')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
 
         actions = iter(args)
-        lines_to_check, all_lines = [], []
+        ids, balance_ids, total_ids, move_line_ids = [], set(), set(), set()
         for lines, vals in zip(actions, actions):
-            if any(k not in cls._check_modify_exclude for k in vals):
-                lines_to_check.extend(lines)
-            all_lines.extend(lines)
+            ids.extend(l.id for l in lines)
+            if set(vals) & {'debit', 'credit', 'account', 'move_line'}:
+                balance_ids.update(l.id for l in lines)
+            if set(vals) & {'debit', 'credit', 'account', 'move_line', 'date',
+                    'internal_company', 'state'}:
+                total_ids.update(l.id for l in lines)
+            if vals.get('move_line'):
+                move_line_ids.add(vals['move_line'])
+
+        # Read the current move lines to also validate the ones that lose
+        # analytic lines
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.select(table.move_line,
+                    where=reduce_ids(table.id, sub_ids)
+                    & (table.move_line != Null),
+                    group_by=table.move_line))
+            move_line_ids.update(r for r, in cursor)
 
-        move_lines = set([l.move_line for l in all_lines if l.move_line])
+        balance_ids = sorted(balance_ids)
+        total_ids = sorted(total_ids)
+        Balance.remove_lines(balance_ids)
+        Total.remove_lines(total_ids)
         super(AnalyticLine, cls).write(*args)
-        move_lines |= set([l.move_line for l in all_lines if l.move_line])
+        Balance.add_lines(balance_ids)
+        Total.add_lines(total_ids)
 
-        lines_to_check = []
-        for lines, vals in zip(actions, actions):
-            if any(k not in cls._check_modify_exclude for k in vals):
-                lines_to_check.extend(lines)
-        MoveLine.validate_analytic_lines(list(move_lines))
-        todraft_lines = [l for l in all_lines
-            if (not l.move_line and l.state != 'draft')]
-        # Call super to avoid_recursion error:
-        if todraft_lines:
-            super(AnalyticLine, cls).write(todraft_lines, {
-                    'state': 'draft',
-                    })
+        MoveLine.validate_analytic_lines(
+            MoveLine.browse(sorted(move_line_ids)))
+        for sub_ids in grouped_slice(ids):
+            cls._set_state('draft', table.select(table.id,
+                    where=reduce_ids(table.id, sub_ids)
+                    & (table.move_line == Null)))
 
     @classmethod
     def delete(cls, lines):
-        MoveLine = Pool().get('account.move.line')
+        pool = Pool()
+        Balance = pool.get('analytic_account.line.balance')
+        MoveLine = pool.get('account.move.line')
+        Total = pool.get('analytic_account.line.total')
 
         move_lines = list(set([l.move_line for l in lines if l.move_line]))
+        Balance.remove_lines([l.id for l in lines])
+        Total.remove_lines([l.id for l in lines])
         super(AnalyticLine, cls).delete(lines)
         MoveLine.validate_analytic_lines(move_lines)
@@ -0,0 +1,247 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Opt-in instrumentation of the analytic state hooks.
+
+It is enabled with the instrumentation option of the analytic_line_state
+section of the configuration file:
+
+    [analytic_line_state]
+    instrumentation = True
+
+Each instrumented call, even failing, is logged at DEBUG level with its wall
+time, the number of SQL statements, the rows touched by them and the rows
+loaded. The statements are counted by wrapping the cursors created from the
+connection of the transaction during the call.
+The totals of each transaction are logged at INFO level when it ends.
+'''
+import logging
+import time
+from contextlib import contextmanager
+from functools import wraps
+from weakref import WeakKeyDictionary
+
+from trytond import config
+from trytond.model import Model
+from trytond.transaction import Transaction
+
+__all__ = ['enabled', 'measure', 'instrumented', 'summary']
+
+logger = logging.getLogger(__name__)
+_summaries = WeakKeyDictionary()
+
+
+def enabled():
+    return config.getboolean(
+        'analytic_line_state', 'instrumentation', default=False)
+
+
+def _count_rows(cursor, stats):
+    'Count the rows touched by the statement executed by cursor'
+    if cursor.description is None and cursor.rowcount and cursor.rowcount > 0:
+        stats['rows'] += cursor.rowcount
+
+
+class CountingCursor(object):
+    'Cursor wrapper that counts the statements and the touched and read rows'
+
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def execute(self, *args, **kwargs):
+        self._stats['queries'] += 1
+        result = self._cursor.execute(*args, **kwargs)
+        _count_rows(self._cursor, self._stats)
+        return result
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._stats['records'] += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._stats['records'] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._stats['records'] += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._stats['records'] += 1
+            yield row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return self._cursor.__exit__(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def _counting_cursor_factory(factory, stats):
+    'Return a subclass of the cursor factory that counts like CountingCursor'
+
+    class Cursor(factory):
+
+        def execute(self, *args, **kwargs):
+            stats['queries'] += 1
+            result = super().execute(*args, **kwargs)
+            _count_rows(self, stats)
+            return result
+
+        def fetchone(self):
+            row = super().fetchone()
+            if row is not None:
+                stats['records'] += 1
+            return row
+
+        def fetchmany(self, *args, **kwargs):
+            rows = super().fetchmany(*args, **kwargs)
+            stats['records'] += len(rows)
+            return rows
+
+        def fetchall(self):
+            rows = super().fetchall()
+            stats['records'] += len(rows)
+            return rows
+
+        def __iter__(self):
+            for row in super().__iter__():
+                stats['records'] += 1
+                yield row
+
+    return Cursor
+
+
+@contextmanager
+def _counting_cursors(connection, stats):
+    '''
+    Make the cursors created by the connection count their statements in
+    stats while keeping the same connection object.
+    '''
+    if hasattr(connection, 'cursor_factory'):
+        # The cursor method of psycopg2 can not be replaced
+        factory = connection.cursor_factory
+        connection.cursor_factory = _counting_cursor_factory(
+            factory or type(connection.cursor()), stats)
+        try:
+            yield
+        finally:
+            connection.cursor_factory = factory
+    else:
+        previous = vars(connection).get('cursor')
+        cursor = connection.cursor
+        connection.cursor = (
+            lambda *args, **kwargs: CountingCursor(
+                cursor(*args, **kwargs), stats))
+        try:
+            yield
+        finally:
+            if previous is None:
+                del connection.cursor
+            else:
+                connection.cursor = previous
+
+
+class SummaryDataManager(object):
+    'Log the summary of the transaction when it ends'
+
+    def __eq__(self, other):
+        if not isinstance(other, SummaryDataManager):
+            return NotImplemented
+        return True
+
+    def abort(self, trans):
+        pass
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        self._log(trans, 'committed')
+
+    def tpc_abort(self, trans):
+        self._log(trans, 'rolled back')
+
+    def _log(self, trans, status):
+        for name, stats in sorted(_summaries.pop(trans, {}).items()):
+            logger.info('%s (%s): %s calls, %s records in %.3fs, '
+                '%s queries, %s rows touched, %s rows loaded',
+                name, status, stats['calls'], stats['records_in'],
+                stats['seconds'], stats['queries'], stats['rows'],
+                stats['records'])
+
+
+@contextmanager
+def measure(name, records=0):
+    '''
+    Measure the block and yield its statistics:
+    seconds, queries, rows (touched) and records (loaded)
+    The statements of the nested measures are also counted.
+    '''
+    transaction = Transaction()
+    stats = {
+        'calls': 1,
+        'records_in': records,
+        'seconds': 0.,
+        'queries': 0,
+        'rows': 0,
+        'records': 0,
+        }
+    start = time.perf_counter()
+    status = 'failed'
+    try:
+        with _counting_cursors(transaction.connection, stats):
+            yield stats
+        status = 'done'
+    finally:
+        stats['seconds'] = time.perf_counter() - start
+        logger.debug('%s (%s): %s records in %.3fs, %s queries, '
+            '%s rows touched, %s rows loaded', name, status, records,
+            stats['seconds'], stats['queries'], stats['rows'],
+            stats['records'])
+        totals = _summaries.setdefault(transaction, {}).setdefault(
+            name, dict.fromkeys(stats, 0))
+        for key, value in stats.items():
+            totals[key] += value
+        transaction.join(SummaryDataManager())
+
+
+def summary(transaction=None):
+    'Return the statistics of the instrumented calls of the transaction'
+    if transaction is None:
+        transaction = Transaction()
+    return {k: v.copy() for k, v in _summaries.get(transaction, {}).items()}
+
+
+def _count_records(args):
+    if args and isinstance(args[0], Model):
+        return 1
+    return sum(len(a) for a in args[1:] if isinstance(a, (list, tuple)))
+
+
+def instrumented(name):
+    'Decorate a method to measure its calls when instrumentation is enabled'
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            with measure(name, _count_records(args)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
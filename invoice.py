@@ -1,6 +1,6 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 
 __all__ = ['InvoiceLine']
 
@@ -10,30 +10,52 @@ class InvoiceLine(metaclass=PoolMeta):
 
     def get_move_lines(self):
         lines = super(InvoiceLine, self).get_move_lines()
+        self.set_move_lines_analytic([(self, lines)])
+        return lines
+
+    @classmethod
+    def set_move_lines_analytic(cls, invoice_move_lines):
+        '''
+        Set the analytic lines of the move lines of a batch of invoice lines:
+        [(invoice_line, [move_line])]
+        The analytic lines are created with the state they will be validated
+        to.
+        '''
+        MoveLine = Pool().get('account.move.line')
 
-        if not hasattr(self, 'analytic_accounts'):
-            return lines
-
-        if self.invoice and self.invoice.type:
-            type_ = self.invoice.type
-        else:
-            type_ = self.invoice_type
-        # analytic_invoice add analytic accounts when is supplier invoice (in)
-        # See issue5909
-        # In case the invoice line has analytic accounts and customer invoice,
-        # copy analytic lines to move lines.
-        if type_ == 'out' and self.analytic_accounts:
-            date = self.invoice.accounting_date or self.invoice.invoice_date
+        if not hasattr(cls, 'analytic_accounts'):
+            return
+
+        dates = {}
+        move_lines = []
+        for invoice_line, lines in invoice_move_lines:
+            if invoice_line.invoice and invoice_line.invoice.type:
+                type_ = invoice_line.invoice.type
+            else:
+                type_ = invoice_line.invoice_type
+            # analytic_invoice add analytic accounts when is supplier invoice
+            # (in) See issue5909
+            # In case the invoice line has analytic accounts and customer
+            # invoice, copy analytic lines to move lines.
+            if type_ != 'out' or not invoice_line.analytic_accounts:
+                continue
+            entries = [e for e in invoice_line.analytic_accounts if e.account]
+            if not entries:
+                continue
+            invoice = invoice_line.invoice
+            if invoice not in dates:
+                dates[invoice] = (
+                    invoice.accounting_date or invoice.invoice_date)
+            date = dates[invoice]
             for line in lines:
                 analytic_lines = []
-                for entry in self.analytic_accounts:
-                    if not entry.account:
-                        continue
-                    analytic_lines.extend(
-                        entry.get_analytic_lines(line, date))
+                for entry in entries:
+                    analytic_lines.extend(entry.get_analytic_lines(line, date))
                 if analytic_lines:
                     line.analytic_lines = analytic_lines
-        return lines
+                    move_lines.append(line)
+
+        MoveLine.preset_analytic_lines_state(move_lines)
 
     @classmethod
     def view_attributes(cls):
@@ -0,0 +1,346 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Benchmark of the analytic line state hot paths at production scale.
+
+It generates a synthetic chart of accounts, analytic roots and a workload of
+move lines with analytic splits, times the operations overridden by the
+module and counts the SQL queries, the touched rows and the loaded rows of
+each one. The report is written as JSON.
+
+The database is set up like the tests (DB_NAME and TRYTOND_DATABASE_URI
+environment variables), for example:
+
+    DB_NAME=bench TRYTOND_DATABASE_URI=postgresql:/// \\
+        python -m trytond.modules.analytic_line_state.tests.benchmark \\
+        --accounts 10000 --roots 20 --lines 1000000 --output report.json
+'''
+import argparse
+import datetime
+import json
+import random
+import sys
+from contextlib import contextmanager
+from decimal import Decimal
+
+from trytond import backend
+from trytond.modules.analytic_line_state.instrumentation import measure
+from trytond.pool import Pool
+from trytond.tests.test_tryton import (
+    CONTEXT, DB_NAME, USER, activate_module)
+from trytond.transaction import Transaction, TransactionError
+
+
+class Benchmark(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.operations = {}
+
+    @contextmanager
+    def measure(self, name, records):
+        'Time the block and count its queries'
+        with measure(name, records) as stats:
+            yield
+        operation = self.operations.setdefault(name, {
+                'calls': 0,
+                'records': 0,
+                'seconds': 0.,
+                'queries': 0,
+                'rows': 0,
+                'loaded': 0,
+                })
+        operation['calls'] += 1
+        operation['records'] += records
+        operation['seconds'] += stats['seconds']
+        operation['queries'] += stats['queries']
+        operation['rows'] += stats['rows']
+        operation['loaded'] += stats['records']
+        if self.options.verbose:
+            print('%s: %s records in %.3fs, %s queries' % (
+                    name, records, stats['seconds'], stats['queries']),
+                file=sys.stderr)
+
+    def setup(self):
+        'Create the company, the charts and the configuration'
+        from trytond.modules.account.tests import (
+            create_chart, get_fiscalyear)
+        from trytond.modules.company.tests import create_company
+        pool = Pool()
+        Account = pool.get('account.account')
+        AnalyticAccount = pool.get('analytic_account.account')
+        Journal = pool.get('account.journal')
+        Party = pool.get('party.party')
+
+        self.company = create_company()
+        self.party = Party(name='Party')
+        self.party.save()
+        with self.set_company():
+            create_chart(self.company)
+            fiscalyear = get_fiscalyear(self.company)
+            fiscalyear.save()
+            fiscalyear.create_period([fiscalyear])
+            self.period = fiscalyear.periods[0]
+            self.journal, = Journal.search([('code', '=', 'EXP')], limit=1)
+
+            expense, = Account.search([
+                    ('company', '=', self.company.id),
+                    ('type.expense', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            self.payable, = Account.search([
+                    ('company', '=', self.company.id),
+                    ('type.payable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            self.accounts = [expense] + Account.create([{
+                        'name': 'Expense %s' % i,
+                        'code': 'E%s' % i,
+                        'type': expense.type.id,
+                        } for i in range(1, self.options.accounts)])
+
+            roots = AnalyticAccount.create([{
+                        'name': 'Root %s' % i,
+                        'type': 'root',
+                        } for i in range(self.options.roots)])
+            children = AnalyticAccount.create([{
+                        'name': 'Analytic %s-%s' % (r, c),
+                        'type': 'normal',
+                        'root': root.id,
+                        'parent': root.id,
+                        } for r, root in enumerate(roots)
+                    for c in range(self.options.analytic_accounts)])
+            self.children = {}
+            for child in children:
+                self.children.setdefault(child.root, []).append(child)
+            self.analytic_accounts = children
+
+            required = roots[:self.options.required_roots]
+            optional = roots[self.options.required_roots:]
+            others = Account.search([
+                    ('company', '=', self.company.id),
+                    ('type', '!=', None),
+                    ('id', 'not in', [a.id for a in self.accounts]),
+                    ('id', '!=', self.payable.id),
+                    ])
+            actions = []
+            if required:
+                actions.extend([required, {
+                            'analytic_required': [('add', [
+                                        a.id for a in self.accounts])],
+                            }])
+            if optional:
+                actions.extend([optional, {
+                            'analytic_optional': [('add', [
+                                        a.id for a in self.accounts])],
+                            }])
+            actions.extend([roots, {
+                        'analytic_forbidden': [('add', [self.payable.id])],
+                        'analytic_optional': [('add', [
+                                    a.id for a in others])],
+                        }])
+            AnalyticAccount.write(*actions)
+            self.required = required
+
+    @contextmanager
+    def set_company(self):
+        from trytond.modules.company.tests import set_company
+        with set_company(self.company):
+            yield
+
+    def amount(self):
+        return Decimal(self.random.randint(100, 100000)) / 100
+
+    def splits(self, amount):
+        'Split amount in 1 to max splits parts'
+        count = self.random.randint(1, self.options.splits)
+        amounts = []
+        for _ in range(count - 1):
+            part = (amount / count).quantize(Decimal('0.01'))
+            amounts.append(part)
+        amounts.append(amount - sum(amounts))
+        return amounts
+
+    def analytic_values(self, line, amount):
+        values = []
+        for root in self.required:
+            for split in self.splits(amount):
+                values.append({
+                        'account': self.random.choice(self.children[root]).id,
+                        'move_line': line.id,
+                        'debit': split,
+                        'credit': Decimal(0),
+                        'date': self.period.start_date,
+                        })
+        return values
+
+    def create_moves(self, count):
+        'Create count moves of two lines and return them with their amounts'
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+
+        moves = Move.create([{
+                    'period': self.period.id,
+                    'journal': self.journal.id,
+                    'date': self.period.start_date,
+                    } for _ in range(count)])
+        amounts = [self.amount() for _ in moves]
+        vlist = []
+        for move, amount in zip(moves, amounts):
+            vlist.append({
+                    'move': move.id,
+                    'account': self.random.choice(self.accounts).id,
+                    'debit': amount,
+                    'credit': Decimal(0),
+                    })
+            vlist.append({
+                    'move': move.id,
+                    'account': self.payable.id,
+                    'party': self.party.id,
+                    'debit': Decimal(0),
+                    'credit': amount,
+                    })
+        with self.measure('MoveLine.create', len(vlist)):
+            lines = MoveLine.create(vlist)
+        return moves, lines[::2], amounts
+
+    def add_analytic_lines(self, lines, amounts):
+        AnalyticLine = Pool().get('analytic_account.line')
+        vlist = []
+        for line, amount in zip(lines, amounts):
+            vlist.extend(self.analytic_values(line, amount))
+        with self.measure('AnalyticLine.create', len(vlist)):
+            return AnalyticLine.create(vlist)
+
+    def run(self):
+        pool = Pool()
+        AnalyticAccount = pool.get('analytic_account.account')
+        AnalyticLine = pool.get('analytic_account.line')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        transaction = Transaction()
+        batch = self.options.batch
+
+        with self.set_company():
+            # Fill the database up to the requested number of move lines
+            filled = 0
+            while filled < self.options.lines:
+                count = min(batch, (self.options.lines - filled) // 2) or 1
+                moves, lines, amounts = self.create_moves(count)
+                self.add_analytic_lines(lines, amounts)
+                filled += 2 * count
+                transaction.commit()
+
+            # Workload on a batch of draft moves
+            moves, lines, amounts = self.create_moves(batch)
+            analytic_lines = self.add_analytic_lines(lines, amounts)
+
+            # The accounts are written to revalidate the analytic lines
+            with self.measure('MoveLine.write', len(lines)):
+                MoveLine.write(*sum(([[l], {
+                                    'account': self.random.choice(
+                                        self.accounts).id,
+                                    }] for l in lines), []))
+
+            with self.measure('MoveLine.write description', len(lines)):
+                MoveLine.write(lines, {'description': 'Benchmark'})
+
+            first_splits = {}
+            for analytic_line in analytic_lines:
+                first_splits.setdefault(analytic_line.move_line.id,
+                    analytic_line)
+            first_splits = list(first_splits.values())
+            with self.measure('AnalyticLine.write', 2 * len(first_splits)):
+                for sign in [1, -1]:
+                    AnalyticLine.write(*sum(([[l], {
+                                        'debit': l.debit + sign,
+                                        }] for l in first_splits), []))
+
+            with self.measure('validate_analytic_lines', len(lines)):
+                MoveLine.validate_analytic_lines(lines)
+
+            with self.measure('Move.post', len(moves)):
+                Move.post(moves)
+
+            with self.measure('AnalyticAccount.query_get',
+                    len(self.analytic_accounts)):
+                cursor = transaction.connection.cursor()
+                cursor.execute(*AnalyticAccount.query_get(
+                        [a.id for a in self.analytic_accounts],
+                        ['debit', 'credit', 'balance']))
+                cursor.fetchall()
+
+            moves, lines, amounts = self.create_moves(batch)
+            self.add_analytic_lines(lines, amounts)
+            to_delete = [l for m in moves for l in m.lines]
+            with self.measure('MoveLine.delete', len(to_delete)):
+                MoveLine.delete(to_delete)
+            transaction.commit()
+
+    def report(self):
+        operations = {}
+        for name, operation in self.operations.items():
+            operation = operation.copy()
+            if operation['records']:
+                operation['queries_per_record'] = (
+                    operation['queries'] / operation['records'])
+                operation['milliseconds_per_record'] = (
+                    1000 * operation['seconds'] / operation['records'])
+            operations[name] = operation
+        return {
+            'date': datetime.datetime.now().isoformat(),
+            'backend': backend.name,
+            'parameters': vars(self.options),
+            'operations': operations,
+            }
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--accounts', type=int, default=100,
+        help='number of expense accounts')
+    parser.add_argument('--roots', type=int, default=20,
+        help='number of analytic roots')
+    parser.add_argument('--required-roots', type=int, default=2,
+        help='number of roots required on the expense accounts')
+    parser.add_argument('--analytic-accounts', type=int, default=5,
+        help='number of analytic accounts per root')
+    parser.add_argument('--lines', type=int, default=10000,
+        help='number of move lines to generate')
+    parser.add_argument('--splits', type=int, default=5,
+        help='maximum number of analytic splits per root and line')
+    parser.add_argument('--batch', type=int, default=500,
+        help='number of moves per timed batch')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', '-o', help='JSON report file')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    options = parser.parse_args(arguments)
+
+    activate_module('analytic_line_state')
+    extras = {}
+    while True:
+        benchmark = Benchmark(options)
+        with Transaction().start(
+                DB_NAME, USER, context=CONTEXT, **extras) as transaction:
+            try:
+                benchmark.setup()
+                transaction.commit()
+                benchmark.run()
+            except TransactionError as e:
+                transaction.rollback()
+                e.fix(extras)
+                continue
+        break
+
+    report = json.dumps(benchmark.report(), indent=2, default=str)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            fp.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,16 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import configparser
 import datetime
+import re
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
+from unittest.mock import patch
 
+from trytond import backend, config
 from trytond.exceptions import UserError
+from trytond.model import Index
+from trytond.model.exceptions import AccessError
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.transaction import Transaction
 from trytond.pool import Pool
@@ -12,8 +18,11 @@ from trytond.pool import Pool
 from trytond.modules.company.tests import (CompanyTestMixin, create_company,
     set_company)
 from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.currency.tests import create_currency
 
 from trytond.modules.account_invoice.tests import set_invoice_sequences
+from trytond.modules.analytic_line_state.instrumentation import (
+    measure, summary)
 
 
 class TestCase(CompanyTestMixin, ModuleTestCase):
@@ -234,6 +243,14 @@ class TestCase(CompanyTestMixin, ModuleTestCase):
             with self.assertRaises(UserError):
                 Move.post(missing_analytic_moves)
 
+            # All the moves that can not be posted are reported at once
+            missing_analytic_moves = Move.create([missing_analytic_vals,
+                    missing_analytic_vals])
+            with self.assertRaises(UserError) as cm:
+                Move.post(missing_analytic_moves)
+            for move in missing_analytic_moves:
+                self.assertIn(move.rec_name, cm.exception.message)
+
             # Can not create move with analytic in analytic forbidden account
             unexpected_analytic_vals = valid_move_vals.copy()
             unexpected_analytic_vals['lines'] = [
@@ -254,6 +271,7 @@ class TestCase(CompanyTestMixin, ModuleTestCase):
         Account = pool.get('account.account')
         AnalyticAccount = pool.get('analytic_account.account')
         AnalyticLine = pool.get('analytic_account.line')
+        Balance = pool.get('analytic_account.line.balance')
         Journal = pool.get('account.journal')
         Move = pool.get('account.move')
         Party = pool.get('party.party')
@@ -384,6 +402,38 @@ class TestCase(CompanyTestMixin, ModuleTestCase):
             self.assertEqual(line2.state, 'valid')
             self.assertEqual(line1.state, 'valid')
 
+            # The balance of the analytic lines is kept by move line and root
+            balance, = Balance.search([
+                    ('move_line', '=', expense_move_line.id),
+                    ])
+            self.assertEqual(balance.root, project1.root)
+            self.assertEqual(balance.balance, Decimal(1100))
+            self.assertEqual(balance.line_count, 2)
+
+            # The balances follow the root of the analytic account
+            old_root, old_parent = project1.root, project1.parent
+            new_root, = AnalyticAccount.create([{
+                        'name': 'New Root',
+                        'type': 'root',
+                        }])
+            AnalyticAccount.write([project1], {
+                    'root': new_root.id,
+                    'parent': new_root.id,
+                    })
+            balance, = Balance.search([
+                    ('move_line', '=', expense_move_line.id),
+                    ])
+            self.assertEqual(balance.root, new_root)
+            self.assertEqual(balance.balance, Decimal(1100))
+            AnalyticAccount.write([project1], {
+                    'root': old_root.id,
+                    'parent': old_parent.id,
+                    })
+            balance, = Balance.search([
+                    ('move_line', '=', expense_move_line.id),
+                    ])
+            self.assertEqual(balance.root, old_root)
+
             # Can post the move
             Move.post([draft_move])
             self.assertEqual(draft_move.state, 'posted')
@@ -469,5 +519,1463 @@ class TestCase(CompanyTestMixin, ModuleTestCase):
                 move = Move.create(values)
                 Move.post(move)
 
+    @with_transaction()
+    def test0050deferred_analytic_validation(self):
+        'Test analytic line state validation deferred until commit'
+        pool = Pool()
+        Account = pool.get('account.account')
+        AnalyticAccount = pool.get('analytic_account.account')
+        AnalyticLine = pool.get('analytic_account.line')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        Party = pool.get('party.party')
+        Company = pool.get('company.company')
+        transaction = Transaction()
+
+        party, = Party.search([('name', '=', 'Party')])
+        company, = Company.search([])
+        with set_company(company):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            set_invoice_sequences(fiscalyear)
+            fiscalyear.save()
+            fiscalyear.create_period([fiscalyear])
+            period = fiscalyear.periods[0]
+
+            journal_expense, = Journal.search([
+                    ('code', '=', 'EXP'),
+                    ])
+            expense, = Account.search([
+                    ('type.expense', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            payable, = Account.search([
+                    ('type.payable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            project1, = AnalyticAccount.search([
+                    ('code', '=', 'P1'),
+                    ])
+
+            move, = Move.create([{
+                        'period': period.id,
+                        'journal': journal_expense.id,
+                        'date': period.start_date,
+                        'lines': [
+                            ('create', [{
+                                        'account': expense.id,
+                                        'debit': Decimal(1100),
+                                        }, {
+                                        'party': party.id,
+                                        'account': payable.id,
+                                        'credit': Decimal(1100),
+                                        }]),
+                            ],
+                        }])
+            expense_line, = [l for l in move.lines if l.account == expense]
+
+            with transaction.set_context(defer_analytic_validation=True):
+                lines = AnalyticLine.create([{
+                            'debit': Decimal(600),
+                            'account': project1.id,
+                            'move_line': expense_line.id,
+                            'date': period.start_date,
+                            }, {
+                            'debit': Decimal(500),
+                            'account': project1.id,
+                            'move_line': expense_line.id,
+                            'date': period.start_date,
+                            }])
+                self.assertTrue(all(l.state == 'draft' for l in lines))
+
+                # Posting validates the queued move lines first
+                Move.post([move])
+            self.assertEqual(move.state, 'posted')
+            self.assertTrue(all(l.state == 'valid' for l in lines))
+
+    @with_transaction()
+    def test0060analytic_line_indexes(self):
+        'Test the analytic line hot queries use the new indexes'
+        pool = Pool()
+        AnalyticAccount = pool.get('analytic_account.account')
+        AnalyticLine = pool.get('analytic_account.line')
+        MoveLine = pool.get('account.move.line')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        t = AnalyticLine.__table__()
+
+        for index in [
+                Index(t, (t.move_line, Index.Range()),
+                    (t.account, Index.Range())),
+                Index(t, (t.account, Index.Range()),
+                    (t.state, Index.Equality(cardinality='low'))),
+                Index(t, (t.account, Index.Range()), (t.date, Index.Range()),
+                    where=t.state == 'valid'),
+                ]:
+            self.assertIn(index, AnalyticLine._sql_indexes)
+
+        def index_names(*columns):
+            'Return the names of the indexes of the columns in the database'
+            if backend.name == 'postgresql':
+                cursor.execute('SELECT indexname, indexdef FROM pg_indexes '
+                    'WHERE tablename = %s', (AnalyticLine._table,))
+            else:
+                cursor.execute('SELECT name, sql FROM sqlite_master '
+                    'WHERE type = \'index\' AND tbl_name = ?',
+                    (AnalyticLine._table,))
+            columns = '(%s)' % ','.join(columns)
+            return {n for n, d in cursor
+                if columns in re.sub(r'[\s"]', '', d or '')}
+
+        move_line_account = index_names('move_line', 'account')
+        account_state = index_names('account', 'state')
+        account_date = index_names('account', 'date')
+        self.assertTrue(move_line_account)
+        self.assertTrue(account_state)
+
+        account_ids = [1]
+        if backend.name == 'postgresql':
+            # Fill a large dataset for the planner
+            company = create_company()
+            with set_company(company):
+                root, = AnalyticAccount.create([{
+                            'name': 'Root',
+                            'type': 'root',
+                            }])
+                accounts = AnalyticAccount.create([{
+                            'name': 'Account %s' % i,
+                            'type': 'normal',
+                            'root': root.id,
+                            'parent': root.id,
+                            } for i in range(10)])
+            account_ids = [accounts[0].id]
+            today = datetime.date.today()
+            cursor.execute(*t.insert([t.account, t.internal_company,
+                        t.date, t.debit, t.credit, t.state, t.create_uid,
+                        t.create_date],
+                    [[accounts[i % len(accounts)].id, company.id,
+                            today - datetime.timedelta(days=i % 365),
+                            Decimal(1), Decimal(0),
+                            'valid' if i % 10 else 'draft',
+                            transaction.user, datetime.datetime.now()]
+                        for i in range(20000)]))
+            cursor.execute('ANALYZE "%s"' % AnalyticLine._table)
+            explain = 'EXPLAIN '
+        else:
+            explain = 'EXPLAIN QUERY PLAN '
+
+        def plan(query):
+            query, params = tuple(query)
+            cursor.execute(explain + query, params)
+            return ' '.join(str(r) for r in cursor.fetchall())
+
+        def uses(indexes, query_plan):
+            return any(i in query_plan for i in indexes)
+
+        for valid in [True, False]:
+            query_plan = plan(MoveLine._analytic_lines_query([1], valid))
+            if backend.name == 'postgresql':
+                # The planner may prefer the index of the move line field
+                # which the composite index extends
+                self.assertNotIn('Seq Scan on %s' % AnalyticLine._table,
+                    query_plan)
+            else:
+                self.assertTrue(
+                    uses(move_line_account, query_plan), query_plan)
+        with transaction.set_context(posted=True):
+            query = AnalyticAccount.query_get(account_ids, ['balance'])
+        query_plan = plan(query)
+        if backend.name == 'postgresql':
+            self.assertTrue(uses(account_state | account_date, query_plan),
+                query_plan)
+        else:
+            # SQLite does not create the partial index with parameters
+            self.assertFalse(account_date)
+            self.assertTrue(uses(account_state, query_plan), query_plan)
+
+    @with_transaction()
+    def test0070instrumentation(self):
+        'Test instrumentation of the analytic state hooks'
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+
+        MoveLine.validate_analytic_lines([])
+        self.assertEqual(summary(), {})
+
+        try:
+            config.add_section('analytic_line_state')
+        except configparser.DuplicateSectionError:
+            pass
+        config.set('analytic_line_state', 'instrumentation', 'True')
+        self.addCleanup(config.set,
+            'analytic_line_state', 'instrumentation', 'False')
+
+        MoveLine.validate_analytic_lines([])
+        MoveLine.validate_analytic_lines([])
+        stats = summary()['account.move.line.validate_analytic_lines']
+        self.assertEqual(stats['calls'], 2)
+        self.assertGreaterEqual(stats['seconds'], 0)
+
+        # The statements are counted on the connection of the transaction
+        transaction = Transaction()
+        connection = transaction.connection
+        with measure('test', 1) as stats:
+            self.assertIs(transaction.connection, connection)
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+        self.assertEqual(stats['queries'], 1)
+        self.assertEqual(stats['records'], 1)
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1')
+        self.assertEqual(stats['queries'], 1)
+
+        # The failing calls are also recorded
+        with self.assertRaises(ZeroDivisionError):
+            with measure('test'):
+                1 / 0
+        self.assertEqual(summary()['test']['calls'], 2)
+
+    @with_transaction()
+    def test0080move_line_write_revalidation(self):
+        'Test move line write revalidates only on relevant fields'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Party = pool.get('party.party')
+
+        party = Party(name='Party')
+        party.save()
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            fiscalyear.create_period([fiscalyear])
+            period = fiscalyear.periods[0]
+            journal_expense, = Journal.search([
+                    ('code', '=', 'EXP'),
+                    ])
+            expense, = Account.search([
+                    ('type.expense', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            payable, = Account.search([
+                    ('type.payable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            move, = Move.create([{
+                        'period': period.id,
+                        'journal': journal_expense.id,
+                        'date': period.start_date,
+                        'lines': [
+                            ('create', [{
+                                        'account': expense.id,
+                                        'debit': Decimal(100),
+                                        }, {
+                                        'party': party.id,
+                                        'account': payable.id,
+                                        'credit': Decimal(100),
+                                        }]),
+                            ],
+                        }])
+            line, = [l for l in move.lines if l.account == expense]
+
+            with patch.object(MoveLine, 'validate_analytic_lines') as validate:
+                MoveLine.write([line], {'description': 'Description'})
+                validate.assert_not_called()
+
+                MoveLine.write([line], {'description': 'Other'},
+                    [line], {'debit': Decimal(100)})
+                validate.assert_called_once_with([line])
+
+    @with_transaction()
+    def test0090move_line_delete(self):
+        'Test move line delete'
+        pool = Pool()
+        Account = pool.get('account.account')
+        AnalyticAccount = pool.get('analytic_account.account')
+        AnalyticLine = pool.get('analytic_account.line')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Party = pool.get('party.party')
+
+        party = Party(name='Party')
+        party.save()
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            fiscalyear.create_period([fiscalyear])
+            period = fiscalyear.periods[0]
+            journal_expense, = Journal.search([
+                    ('code', '=', 'EXP'),
+                    ])
+            expense, = Account.search([
+                    ('type.expense', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            payable, = Account.search([
+                    ('type.payable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            root, = AnalyticAccount.create([{
+                        'name': 'Root',
+                        'type': 'root',
+                        }])
+            project, = AnalyticAccount.create([{
+                        'name': 'Project',
+                        'type': 'normal',
+                        'root': root.id,
+                        'parent': root.id,
+                        }])
+
+            def create_move():
+                move, = Move.create([{
+                            'period': period.id,
+                            'journal': journal_expense.id,
+                            'date': period.start_date,
+                            'lines': [
+                                ('create', [{
+                                            'account': expense.id,
+                                            'debit': Decimal(100),
+                                            'analytic_lines': [
+                                                ('create', [analytic_line]),
+                                                ],
+                                            }, {
+                                            'party': party.id,
+                                            'account': payable.id,
+                                            'credit': Decimal(100),
+                                            }]),
+                                ],
+                            }])
+                return move
+
+            analytic_line = {
+                'account': project.id,
+                'debit': Decimal(100),
+                'date': period.start_date,
+                }
+            draft, posted = create_move(), create_move()
+            self.assertEqual(AnalyticLine.search([], count=True), 2)
+            Move.post([posted])
+
+            with self.assertRaises(AccessError):
+                MoveLine.delete(list(draft.lines) + list(posted.lines))
+
+            MoveLine.delete(list(draft.lines))
+            analytic_line, = AnalyticLine.search([])
+            self.assertEqual(analytic_line.move_line.move, posted)
+            self.assertEqual(analytic_line.state, 'valid')
+
+    @with_transaction()
+    def test0100post_analytic_check(self):
+        'Test post check of missing and not valid analytic lines'
+        pool = Pool()
+        Account = pool.get('account.account')
+        AnalyticAccount = pool.get('analytic_account.account')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        Party = pool.get('party.party')
+
+        party = Party(name='Party')
+        party.save()
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            fiscalyear.create_period([fiscalyear])
+            period = fiscalyear.periods[0]
+            journal_expense, = Journal.search([
+                    ('code', '=', 'EXP'),
+                    ])
+            expense, = Account.search([
+                    ('type.expense', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            payable, = Account.search([
+                    ('type.payable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            root1, root2 = AnalyticAccount.create([{
+                        'name': 'Root 1',
+                        'type': 'root',
+                        }, {
+                        'name': 'Root 2',
+                        'type': 'root',
+                        }])
+            project1, project2 = AnalyticAccount.create([{
+                        'name': 'Project 1',
+                        'type': 'normal',
+                        'root': root1.id,
+                        'parent': root1.id,
+                        }, {
+                        'name': 'Project 2',
+                        'type': 'normal',
+                        'root': root2.id,
+                        'parent': root2.id,
+                        }])
+            AnalyticAccount.write([root1, root2], {
+                    'analytic_required': [('add', [expense.id])],
+                    })
+
+            def create_move(analytic_lines):
+                move, = Move.create([{
+                            'period': period.id,
+                            'journal': journal_expense.id,
+                            'date': period.start_date,
+                            'lines': [
+                                ('create', [{
+                                            'account': expense.id,
+                                            'debit': Decimal(100),
+                                            'analytic_lines': [
+                                                ('create', analytic_lines),
+                                                ],
+                                            }, {
+                                            'party': party.id,
+                                            'account': payable.id,
+                                            'credit': Decimal(100),
+                                            }]),
+                                ],
+                            }])
+                return move
+
+            def analytic_line(account, amount):
+                return {
+                    'account': account.id,
+                    'debit': amount,
+                    'date': period.start_date,
+                    }
+
+            missing = create_move([analytic_line(project1, Decimal(100))])
+            invalid = create_move([
+                    analytic_line(project1, Decimal(100)),
+                    analytic_line(project2, Decimal(50)),
+                    ])
+            valid = create_move([
+                    analytic_line(project1, Decimal(100)),
+                    analytic_line(project2, Decimal(100)),
+                    ])
+
+            Move.post([valid])
+            self.assertEqual(valid.state, 'posted')
+
+            with self.assertRaises(UserError) as cm:
+                Move.post([missing, invalid])
+            self.assertIn(missing.rec_name, cm.exception.message)
+            self.assertIn(invalid.rec_name, cm.exception.message)
+            self.assertIn(root2.rec_name, cm.exception.description)
+            self.assertNotIn(root1.rec_name, cm.exception.description)
+
+    @with_transaction()
+    def test0110analytic_account_roots(self):
+        'Test root resolution of analytic accounts'
+        pool = Pool()
+        AnalyticAccount = pool.get('analytic_account.account')
+
+        company = create_company()
+        with set_company(company):
+            root1, root2 = AnalyticAccount.create([{
+                        'name': 'Root 1',
+                        'type': 'root',
+                        }, {
+                        'name': 'Root 2',
+                        'type': 'root',
+                        }])
+            project, = AnalyticAccount.create([{
+                        'name': 'Project',
+                        'type': 'normal',
+                        'root': root1.id,
+                        'parent': root1.id,
+                        }])
+            self.assertEqual(
+                AnalyticAccount.get_roots([root1.id, project.id]),
+                {project.id: root1.id})
+
+            AnalyticAccount.write([project], {
+                    'root': root2.id,
+                    'parent': root2.id,
+                    })
+            self.assertEqual(
+                AnalyticAccount.get_roots([project.id]),
+                {project.id: root2.id})
+
+        # Accounts outside the context company are also resolved
+        self.assertEqual(
+            AnalyticAccount.get_roots([project.id]), {project.id: root2.id})
+
+    @with_transaction()
+    def test0120revalidate_analytic_lines(self):
+        'Test mass revalidation of the analytic lines'
+        pool = Pool()
+        Account = pool.get('account.account')
+        AnalyticAccount = pool.get('analytic_account.account')
+        AnalyticLine = pool.get('analytic_account.line')
+        Balance = pool.get('analytic_account.line.balance')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Party = pool.get('party.party')
+        Queue = pool.get('ir.queue')
+        Total = pool.get('analytic_account.line.total')
+
+        party = Party(name='Party')
+        party.save()
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            fiscalyear.create_period([fiscalyear])
+            period = fiscalyear.periods[0]
+            journal_expense, = Journal.search([
+                    ('code', '=', 'EXP'),
+                    ])
+            expense, = Account.search([
+                    ('type.expense', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            payable, = Account.search([
+                    ('type.payable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            root, = AnalyticAccount.create([{
+                        'name': 'Root',
+                        'type': 'root',
+                        }])
+            project, = AnalyticAccount.create([{
+                        'name': 'Project',
+                        'type': 'normal',
+                        'root': root.id,
+                        'parent': root.id,
+                        }])
+            Move.create([{
+                        'period': period.id,
+                        'journal': journal_expense.id,
+                        'date': period.start_date,
+                        'lines': [
+                            ('create', [{
+                                        'account': expense.id,
+                                        'debit': Decimal(100),
+                                        'analytic_lines': [
+                                            ('create', [{
+                                                        'account': project.id,
+                                                        'debit': Decimal(100),
+                                                        'date': (
+                                                            period.start_date),
+                                                        }]),
+                                            ],
+                                        }, {
+                                        'party': party.id,
+                                        'account': payable.id,
+                                        'credit': Decimal(100),
+                                        }]),
+                            ],
+                        } for _ in range(3)])
+            lines = AnalyticLine.search([], order=[('id', 'ASC')])
+            self.assertTrue(all(l.state == 'valid' for l in lines))
+
+            # Break the states and the balances
+            table = AnalyticLine.__table__()
+            AnalyticLine._set_state('draft', table.select(table.id))
+            Balance.delete(Balance.search([]))
+
+            last_id = MoveLine.revalidate_analytic_lines(
+                company=company.id, accounts=[expense.id], chunk=2,
+                commit=False)
+            self.assertEqual(last_id, lines[-1].move_line.id)
+            lines = AnalyticLine.browse(lines)
+            self.assertTrue(all(l.state == 'valid' for l in lines))
+            self.assertEqual(Balance.search([], count=True), 3)
+
+            # Resume after the last move line
+            self.assertEqual(MoveLine.revalidate_analytic_lines(
+                    company=company.id, accounts=[expense.id],
+                    start=last_id, commit=False), last_id)
+
+            # Revalidate with queue tasks of disjoint partitions
+            AnalyticLine._set_state('draft', table.select(table.id))
+            Balance.delete(Balance.search([]))
+            task_ids = MoveLine.enqueue_revalidate_analytic_lines(
+                company=company.id, accounts=[expense.id], size=2)
+            tasks = Queue.browse(task_ids)
+            self.assertEqual(
+                [(t.data['kwargs']['start'], t.data['kwargs']['end'])
+                    for t in tasks],
+                [(None, lines[1].move_line.id),
+                    (lines[1].move_line.id, None)])
+            for task in tasks:
+                task.run()
+            lines = AnalyticLine.browse(lines)
+            self.assertTrue(all(l.state == 'valid' for l in lines))
+            self.assertEqual(Balance.search([], count=True), 3)
+
+            # The periods with totals are revalidated by a single task
+            with patch.object(Total, '_closed_states',
+                    return_value=['open']):
+                task_ids = MoveLine.enqueue_revalidate_analytic_lines(
+                    company=company.id, accounts=[expense.id], size=2)
+            task, = Queue.browse(task_ids)
+            self.assertEqual(task.data['kwargs'].get('start'), None)
+            self.assertEqual(task.data['kwargs'].get('end'), None)
+
+    @with_transaction()
+    def test0130query_get_totals(self):
+        'Test analytic account amounts with the totals of closed periods'
+        pool = Pool()
+        Account = pool.get('account.account')
+        AnalyticAccount = pool.get('analytic_account.account')
+        AnalyticLine = pool.get('analytic_account.line')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        Party = pool.get('party.party')
+        Period = pool.get('account.period')
+        Total = pool.get('analytic_account.line.total')
+        transaction = Transaction()
+
+        party = Party(name='Party')
+        party.save()
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            fiscalyear.create_period([fiscalyear])
+            period1, period2 = sorted(fiscalyear.periods,
+                key=lambda p: p.start_date)[:2]
+            journal_expense, = Journal.search([
+                    ('code', '=', 'EXP'),
+                    ])
+            expense, = Account.search([
+                    ('type.expense', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            payable, = Account.search([
+                    ('type.payable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            root, = AnalyticAccount.create([{
+                        'name': 'Root',
+                        'type': 'root',
+                        }])
+            project, = AnalyticAccount.create([{
+                        'name': 'Project',
+                        'type': 'normal',
+                        'root': root.id,
+                        'parent': root.id,
+                        }])
+
+            def create_move(period, amount, dates):
+                move, = Move.create([{
+                            'period': period.id,
+                            'journal': journal_expense.id,
+                            'date': period.start_date,
+                            'lines': [
+                                ('create', [{
+                                            'account': expense.id,
+                                            'debit': amount,
+                                            }, {
+                                            'party': party.id,
+                                            'account': payable.id,
+                                            'credit': amount,
+                                            }]),
+                                ],
+                            }])
+                line, = [l for l in move.lines if l.account == expense]
+                AnalyticLine.create([{
+                            'account': project.id,
+                            'move_line': line.id,
+                            'debit': amount / len(dates),
+                            'date': date,
+                            } for date in dates])
+                return move
+
+            moves = [
+                create_move(period1, Decimal(100),
+                    [period1.start_date, period1.end_date]),
+                create_move(period1, Decimal(30), [period1.start_date]),
+                create_move(period2, Decimal(40), [period2.start_date]),
+                ]
+            Move.post(moves)
+
+            contexts = [{}, {
+                    'start_date': period1.start_date,
+                    'end_date': period1.end_date,
+                    }, {
+                    'start_date': period1.start_date + datetime.timedelta(1),
+                    }, {
+                    'end_date': period1.end_date - datetime.timedelta(1),
+                    }, {
+                    'posted': True,
+                    }]
+
+            def amounts():
+                cursor = transaction.connection.cursor()
+                result = []
+                for context in contexts:
+                    with transaction.set_context(context):
+                        cursor.execute(*AnalyticAccount.query_get(
+                                [project.id, root.id],
+                                ['debit', 'credit', 'balance']))
+                        result.append(sorted(
+                                tuple(round(v, 2) if v is not None else v
+                                    for v in r) for r in cursor))
+                return result
+
+            expected = amounts()
+            self.assertEqual(Total.search([], count=True), 0)
+            # The posted context restricts to the valid lines
+            self.assertEqual(expected[-1], [r for r in expected[0] if r[1]])
+
+            Period.close([period1])
+            self.assertEqual(Total.search([], count=True), 1)
+            self.assertEqual(amounts(), expected)
+
+            # Totals are updated with the lines of closed periods
+            line = AnalyticLine.search([
+                    ('move_line.move', '=', moves[1].id),
+                    ])
+            AnalyticLine.delete(line)
+            total, = Total.search([])
+            self.assertEqual(total.debit, Decimal(100))
+            self.assertEqual(total.state, 'valid')
+            self.assertEqual(total.line_count, 2)
+            moves[1:2] = []
+            expected = amounts()
+
+            # The state flips move the amounts between the totals
+            line, _ = AnalyticLine.search([
+                    ('move_line.move', '=', moves[0].id),
+                    ], order=[('date', 'ASC')])
+            table = AnalyticLine.__table__()
+            AnalyticLine._set_state('draft',
+                table.select(table.id, where=table.id == line.id))
+            totals = Total.search([], order=[('state', 'ASC')])
+            self.assertEqual(
+                [(t.state, t.debit, t.line_count) for t in totals],
+                [('draft', Decimal(50), 1), ('valid', Decimal(50), 1)])
+            AnalyticLine._set_state('valid',
+                table.select(table.id, where=table.id == line.id))
+            total, = Total.search([])
+            self.assertEqual(
+                (total.state, total.debit, total.line_count),
+                ('valid', Decimal(100), 2))
+            self.assertEqual(total.first_date, period1.start_date)
+            self.assertEqual(total.last_date, period1.end_date)
+            self.assertEqual(amounts(), expected)
+
+            # The extensions of the clause of the lines are honoured
+            query_get = AnalyticLine.query_get
+            with patch.object(AnalyticLine, 'query_get',
+                    side_effect=lambda table: (
+                        query_get(table)
+                        & (table.date != period1.end_date))):
+                self.assertFalse(Total.match_query_get())
+                cursor = transaction.connection.cursor()
+                cursor.execute(*AnalyticAccount.query_get(
+                        [project.id], ['debit']))
+                self.assertEqual(
+                    [(i, round(d, 2)) for i, _, d in cursor],
+                    [(project.id, Decimal(90))])
+            self.assertTrue(Total.match_query_get())
+
+            # The state flips of open periods do not update the totals
+            line, = AnalyticLine.search([
+                    ('move_line.move', '=', moves[1].id),
+                    ])
+            with patch.object(Total, 'remove_lines') as remove_lines, \
+                    patch.object(Total, 'add_lines') as add_lines:
+                AnalyticLine._set_state('draft',
+                    table.select(table.id, where=table.id == line.id))
+                remove_lines.assert_not_called()
+                add_lines.assert_not_called()
+            self.assertEqual(AnalyticLine(line.id).state, 'draft')
+            AnalyticLine._set_state('valid',
+                table.select(table.id, where=table.id == line.id))
+
+            Period.reopen([period1])
+            self.assertEqual(Total.search([], count=True), 0)
+            self.assertEqual(amounts(), expected)
+
+    @with_transaction()
+    def test0140invoice_move_lines_analytic(self):
+        'Test analytic lines of the move lines of invoice lines'
+        pool = Pool()
+        AnalyticAccount = pool.get('analytic_account.account')
+        Entry = pool.get('analytic.account.entry')
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        MoveLine = pool.get('account.move.line')
+
+        company = create_company()
+        with set_company(company):
+            root, = AnalyticAccount.create([{
+                        'name': 'Root',
+                        'type': 'root',
+                        }])
+            project, = AnalyticAccount.create([{
+                        'name': 'Project',
+                        'type': 'normal',
+                        'root': root.id,
+                        'parent': root.id,
+                        }])
+            today = datetime.date.today()
+
+            lines = []
+            for type_ in ['out', 'in']:
+                invoice = Invoice(type=type_, accounting_date=None,
+                    invoice_date=today)
+                invoice_line = InvoiceLine(invoice=invoice,
+                    analytic_accounts=[Entry(root=root, account=project)])
+                move_line = MoveLine(debit=Decimal(0), credit=Decimal(100),
+                    analytic_lines=[])
+                lines.append((invoice_line, [move_line]))
+            InvoiceLine.set_move_lines_analytic(lines)
+
+            (_, [out_line]), (_, [in_line]) = lines
+            analytic_line, = out_line.analytic_lines
+            self.assertEqual(analytic_line.account, project)
+            self.assertEqual(analytic_line.credit, Decimal(100))
+            self.assertEqual(analytic_line.date, today)
+            self.assertEqual(analytic_line.state, 'valid')
+            self.assertEqual(len(in_line.analytic_lines), 0)
+
+    @with_transaction()
+    def test0150analytic_rule_matcher(self):
+        'Test analytic lines set from the rules before the move is saved'
+        pool = Pool()
+        Account = pool.get('account.account')
+        AnalyticAccount = pool.get('analytic_account.account')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Party = pool.get('party.party')
+        Rule = pool.get('analytic_account.rule')
+
+        party = Party(name='Party')
+        party.save()
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            fiscalyear.create_period([fiscalyear])
+            period = fiscalyear.periods[0]
+            journal_expense, = Journal.search([
+                    ('code', '=', 'EXP'),
+                    ])
+            expense, = Account.search([
+                    ('type.expense', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            payable, = Account.search([
+                    ('type.payable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            root, = AnalyticAccount.create([{
+                        'name': 'Root',
+                        'type': 'root',
+                        }])
+            project1, project2 = AnalyticAccount.create([{
+                        'name': 'Project 1',
+                        'type': 'normal',
+                        'root': root.id,
+                        'parent': root.id,
+                        }, {
+                        'name': 'Project 2',
+                        'type': 'normal',
+                        'root': root.id,
+                        'parent': root.id,
+                        }])
+            AnalyticAccount.write([root], {
+                    'analytic_required': [('add', [expense.id])],
+                    })
+
+            self.assertIsNone(MoveLine.analytic_rule_matcher().match({
+                        'company': company.id,
+                        'account': expense.id,
+                        'journal': journal_expense.id,
+                        'party': None,
+                        }))
+
+            party_rule, account_rule, company_rule = Rule.create([{
+                        'sequence': 10,
+                        'company': company.id,
+                        'party': party.id,
+                        'analytic_accounts': [('create', [{
+                                        'root': root.id,
+                                        'account': project2.id,
+                                        }])],
+                        }, {
+                        'sequence': 20,
+                        'company': company.id,
+                        'account': expense.id,
+                        'analytic_accounts': [('create', [{
+                                        'root': root.id,
+                                        'account': project1.id,
+                                        }])],
+                        }, {
+                        'sequence': 30,
+                        'company': company.id,
+                        }])
+            matcher = MoveLine.analytic_rule_matcher()
+            self.assertIs(MoveLine.analytic_rule_matcher(), matcher)
+
+            # The matchers are kept by company
+            company2 = create_company(name='Company 2')
+            with Transaction().set_context(company=company2.id):
+                self.assertIsNot(MoveLine.analytic_rule_matcher(), matcher)
+            self.assertIs(MoveLine.analytic_rule_matcher(), matcher)
+
+            def match(account, party=None):
+                return matcher.match({
+                        'company': company.id,
+                        'account': account.id,
+                        'journal': journal_expense.id,
+                        'party': party.id if party else None,
+                        })
+            self.assertEqual(match(expense), account_rule)
+            self.assertEqual(match(expense, party), party_rule)
+            self.assertEqual(match(payable), company_rule)
+
+            move = Move(company=company, period=period,
+                journal=journal_expense, date=period.start_date)
+            move.lines = [
+                MoveLine(account=expense, party=None, debit=Decimal(100),
+                    credit=Decimal(0)),
+                MoveLine(account=payable, party=party, debit=Decimal(0),
+                    credit=Decimal(100)),
+                ]
+            # The rules are applied by the super chain
+            with patch.object(Rule, 'search', wraps=Rule.search) as search:
+                move._set_analytic_account_from_rule()
+            search.assert_any_call([])
+            self.assertIsNone(move.id)
+            expense_line, payable_line = move.lines
+            analytic_line, = expense_line.analytic_lines
+            self.assertEqual(analytic_line.account, project1)
+            self.assertEqual(analytic_line.debit, Decimal(100))
+            self.assertEqual(analytic_line.state, 'valid')
+            self.assertFalse(getattr(payable_line, 'analytic_lines', None))
+
+            move.save()
+            expense_line, = [l for l in move.lines if l.account == expense]
+            analytic_line, = expense_line.analytic_lines
+            self.assertEqual(analytic_line.state, 'valid')
+
+            Rule.delete([account_rule])
+            self.assertIsNot(MoveLine.analytic_rule_matcher(), matcher)
+            self.assertEqual(
+                MoveLine.analytic_rule_matcher().match({
+                        'company': company.id,
+                        'account': expense.id,
+                        'journal': journal_expense.id,
+                        'party': None,
+                        }),
+                company_rule)
+
+    @with_transaction()
+    def test0160reconcile_writeoff_moves(self):
+        'Test the analytic lines of the write-off and exchange moves'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Configuration = pool.get('account.configuration')
+        AnalyticAccount = pool.get('analytic_account.account')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Party = pool.get('party.party')
+        Rule = pool.get('analytic_account.rule')
+        WriteOff = pool.get('account.move.reconcile.write_off')
+
+        party = Party(name='Party')
+        party.save()
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            fiscalyear.create_period([fiscalyear])
+            period = fiscalyear.periods[0]
+            journal_revenue, = Journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            expense, = Account.search([
+                    ('type.expense', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            receivable, = Account.search([
+                    ('type.receivable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            root, = AnalyticAccount.create([{
+                        'name': 'Root',
+                        'type': 'root',
+                        }])
+            project, = AnalyticAccount.create([{
+                        'name': 'Project',
+                        'type': 'normal',
+                        'root': root.id,
+                        'parent': root.id,
+                        }])
+            AnalyticAccount.write([root], {
+                    'analytic_required': [('add', [expense.id])],
+                    'analytic_optional': [('add', [revenue.id])],
+                    })
+            Rule.create([{
+                        'company': company.id,
+                        'account': expense.id,
+                        'analytic_accounts': [('create', [{
+                                        'root': root.id,
+                                        'account': project.id,
+                                        }])],
+                        }])
+            journal_writeoff, = Journal.create([{
+                        'name': 'Write-Off',
+                        'type': 'write-off',
+                        }])
+            writeoff, = WriteOff.create([{
+                        'name': 'Write-Off',
+                        'journal': journal_writeoff.id,
+                        'debit_account': expense.id,
+                        'credit_account': expense.id,
+                        }])
+
+            moves = Move.create([{
+                        'period': period.id,
+                        'journal': journal_revenue.id,
+                        'date': period.start_date,
+                        'lines': [('create', [{
+                                        'account': revenue.id,
+                                        'credit': Decimal(100),
+                                        }, {
+                                        'account': receivable.id,
+                                        'party': party.id,
+                                        'debit': Decimal(100),
+                                        }, {
+                                        'account': receivable.id,
+                                        'party': party.id,
+                                        'credit': Decimal(100 - i),
+                                        }, {
+                                        'account': revenue.id,
+                                        'debit': Decimal(100 - i),
+                                        }])],
+                        } for i in range(1, 4)])
+            Move.post(moves)
+            lines_list = [[l for l in m.lines if l.account == receivable]
+                for m in moves]
+
+            # The analytic lines of the moves are validated in one pass
+            with patch.object(MoveLine, '_analytic_lines_query',
+                    wraps=MoveLine._analytic_lines_query) as query:
+                reconciliations = MoveLine.reconcile(*lines_list,
+                    writeoff=writeoff, date=period.start_date)
+            self.assertEqual(query.call_count, 2)
+            self.assertEqual(len(reconciliations), 3)
+
+            writeoff_lines = MoveLine.search([
+                    ('account', '=', expense.id),
+                    ])
+            self.assertEqual(
+                sorted(l.debit for l in writeoff_lines),
+                [Decimal(1), Decimal(2), Decimal(3)])
+            for line in writeoff_lines:
+                self.assertEqual(line.move.state, 'posted')
+                analytic_line, = line.analytic_lines
+                self.assertEqual(analytic_line.account, project)
+                self.assertEqual(analytic_line.debit, line.debit)
+                self.assertEqual(analytic_line.state, 'valid')
+            for reconciliation in reconciliations:
+                self.assertEqual(len(reconciliation.lines), 3)
+
+            # The exchange moves of the lines in second currency
+            currency = create_currency('EUR')
+            configuration = Configuration(1)
+            configuration.currency_exchange_debit_account = expense
+            configuration.currency_exchange_credit_account = revenue
+            configuration.save()
+            moves = Move.create([{
+                        'period': period.id,
+                        'journal': journal_revenue.id,
+                        'date': period.start_date,
+                        'lines': [('create', [{
+                                        'account': revenue.id,
+                                        'credit': Decimal(100),
+                                        }, {
+                                        'account': receivable.id,
+                                        'party': party.id,
+                                        'debit': Decimal(100),
+                                        'second_currency': currency.id,
+                                        'amount_second_currency': Decimal(50),
+                                        }, {
+                                        'account': receivable.id,
+                                        'party': party.id,
+                                        'credit': Decimal(100 - i),
+                                        'second_currency': currency.id,
+                                        'amount_second_currency': Decimal(-50),
+                                        }, {
+                                        'account': revenue.id,
+                                        'debit': Decimal(100 - i),
+                                        }])],
+                        } for i in range(1, 3)])
+            Move.post(moves)
+            lines_list = [[l for l in m.lines if l.account == receivable]
+                for m in moves]
+
+            with patch.object(MoveLine, '_analytic_lines_query',
+                    wraps=MoveLine._analytic_lines_query) as query:
+                reconciliations = MoveLine.reconcile(*lines_list,
+                    date=period.start_date)
+            self.assertEqual(query.call_count, 2)
+            self.assertEqual(len(reconciliations), 2)
+
+            exchange_lines = MoveLine.search([
+                    ('account', '=', expense.id),
+                    ('move.journal', '=',
+                        configuration.currency_exchange_journal.id),
+                    ])
+            self.assertEqual(
+                sorted(l.debit for l in exchange_lines),
+                [Decimal(1), Decimal(2)])
+            for line in exchange_lines:
+                self.assertEqual(line.move.state, 'posted')
+                analytic_line, = line.analytic_lines
+                self.assertEqual(analytic_line.account, project)
+                self.assertEqual(analytic_line.debit, line.debit)
+                self.assertEqual(analytic_line.state, 'valid')
+            for reconciliation in reconciliations:
+                self.assertEqual(len(reconciliation.lines), 3)
+
+    @with_transaction()
+    def test0170lines_must_have_analytic(self):
+        'Test the memoized decision of the lines that must have analytic'
+        pool = Pool()
+        Account = pool.get('account.account')
+        AnalyticAccount = pool.get('analytic_account.account')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Party = pool.get('party.party')
+
+        party = Party(name='Party')
+        party.save()
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            fiscalyear.create_period([fiscalyear])
+            period = fiscalyear.periods[0]
+            journal_expense, = Journal.search([
+                    ('code', '=', 'EXP'),
+                    ])
+            expense, = Account.search([
+                    ('type.expense', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            payable, = Account.search([
+                    ('type.payable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            root, = AnalyticAccount.create([{
+                        'name': 'Root',
+                        'type': 'root',
+                        }])
+
+            moves = Move.create([{
+                        'period': period.id,
+                        'journal': journal_expense.id,
+                        'date': period.start_date,
+                        'lines': [('create', [{
+                                        'account': expense.id,
+                                        'debit': Decimal(100),
+                                        }, {
+                                        'party': party.id,
+                                        'account': payable.id,
+                                        'credit': Decimal(100),
+                                        }])],
+                        } for _ in range(3)])
+            lines = [l for m in moves for l in m.lines]
+            expected = [l.account == expense for l in lines]
+
+            must_have_analytic = MoveLine.must_have_analytic
+            calls = []
+
+            def read_must_have_analytic(line):
+                calls.append(line)
+                return must_have_analytic.fget(line)
+
+            with patch.object(MoveLine, 'must_have_analytic',
+                    property(read_must_have_analytic)):
+                self.assertEqual(
+                    MoveLine.lines_must_have_analytic(lines), expected)
+                self.assertEqual(len(calls), 2)
+                self.assertEqual(
+                    [l._must_have_analytic() for l in lines], expected)
+                self.assertEqual(len(calls), 2)
+
+                AnalyticAccount.write([root], {
+                        'analytic_required': [('add', [payable.id])],
+                        })
+                self.assertEqual(
+                    MoveLine.lines_must_have_analytic(lines),
+                    [True] * len(lines))
+                self.assertEqual(len(calls), 4)
+
+            # The overrides of must_have_analytic are honoured with their key
+            AnalyticAccount.write([root], {
+                    'analytic_required': [('remove', [payable.id])],
+                    })
+            with patch.object(MoveLine, 'must_have_analytic',
+                    property(lambda line: line.move == moves[0])):
+                # Without its key the override is memoized by account
+                self.assertEqual(
+                    MoveLine.lines_must_have_analytic(lines),
+                    [True] * len(lines))
+                key = MoveLine._must_have_analytic_key
+                with patch.object(MoveLine, '_must_have_analytic_key',
+                        lambda line: key(line) + (line.move.id,)):
+                    self.assertEqual(
+                        MoveLine.lines_must_have_analytic(lines),
+                        [l.move == moves[0] for l in lines])
+
+    @with_transaction()
+    def test0180analytic_pending_accounts(self):
+        'Test the pending accounts read in batch'
+        pool = Pool()
+        Account = pool.get('account.account')
+        AnalyticAccount = pool.get('analytic_account.account')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            expense, = Account.search([
+                    ('type.expense', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            payable, = Account.search([
+                    ('type.payable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            root1, root2, inactive = AnalyticAccount.create([{
+                        'name': 'Root 1',
+                        'type': 'root',
+                        }, {
+                        'name': 'Root 2',
+                        'type': 'root',
+                        }, {
+                        'name': 'Inactive',
+                        'type': 'root',
+                        'active': False,
+                        }])
+            AnalyticAccount.write([root1], {
+                    'analytic_required': [('add', [expense.id])],
+                    }, [root2], {
+                    'analytic_forbidden': [('add', [expense.id])],
+                    'analytic_optional': [('add', [payable.id])],
+                    })
+
+            accounts = Account.search([])
+            pending = Account.get_analytic_pending_accounts(
+                accounts, 'analytic_pending_accounts')
+            for account in accounts:
+                self.assertEqual(
+                    sorted(pending[account.id]),
+                    sorted(account.on_change_with_analytic_pending_accounts()))
+            self.assertEqual(pending[expense.id], [])
+            self.assertEqual(pending[payable.id], [root1.id])
+
+            roots = [root1, root2]
+            pending = AnalyticAccount.get_analytic_pending_accounts(
+                roots, 'analytic_pending_accounts')
+            for root in roots:
+                self.assertEqual(
+                    sorted(pending[root.id]),
+                    sorted(root.on_change_with_analytic_pending_accounts()))
+            self.assertNotIn(expense.id, pending[root1.id])
+            self.assertIn(payable.id, pending[root1.id])
+            self.assertNotIn(payable.id, pending[root2.id])
+
+            queries = []
+            for ids in [[expense.id], [a.id for a in accounts]]:
+                with measure('pending') as stats:
+                    Account.read(ids, ['analytic_pending_accounts'])
+                queries.append(stats['queries'])
+            self.assertEqual(queries[0], queries[1])
+
+    @with_transaction()
+    def test0190post_invoices_analytic(self):
+        'Test the analytic lines of the moves of posted invoices'
+        pool = Pool()
+        Account = pool.get('account.account')
+        AnalyticAccount = pool.get('analytic_account.account')
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        Journal = pool.get('account.journal')
+        MoveLine = pool.get('account.move.line')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            set_invoice_sequences(fiscalyear)
+            fiscalyear.save()
+            fiscalyear.create_period([fiscalyear])
+            journal_revenue, = Journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            receivable, = Account.search([
+                    ('type.receivable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            root, = AnalyticAccount.create([{
+                        'name': 'Root',
+                        'type': 'root',
+                        }])
+            project, = AnalyticAccount.create([{
+                        'name': 'Project',
+                        'type': 'normal',
+                        'root': root.id,
+                        'parent': root.id,
+                        }])
+            AnalyticAccount.write([root], {
+                    'analytic_required': [('add', [revenue.id])],
+                    })
+            party, = Party.create([{
+                        'name': 'Customer',
+                        'addresses': [('create', [{}])],
+                        }])
+
+            invoices = Invoice.create([{
+                        'type': 'out',
+                        'party': party.id,
+                        'invoice_address': party.addresses[0].id,
+                        'journal': journal_revenue.id,
+                        'account': receivable.id,
+                        'currency': company.currency.id,
+                        'invoice_date': invoice_date,
+                        'lines': [('create', [{
+                                        'account': revenue.id,
+                                        'description': 'Line',
+                                        'quantity': 1,
+                                        'unit_price': Decimal(amount),
+                                        'analytic_accounts': [('create', [{
+                                                        'root': root.id,
+                                                        'account': project.id,
+                                                        }])],
+                                        }])],
+                        } for amount, invoice_date in [
+                        (10, fiscalyear.start_date),
+                        (20, None),
+                        ]])
+
+            with patch.object(InvoiceLine, 'set_move_lines_analytic',
+                    wraps=InvoiceLine.set_move_lines_analytic
+                    ) as set_analytic, \
+                    patch.object(MoveLine, 'validate_analytic_lines',
+                        wraps=MoveLine.validate_analytic_lines
+                        ) as validate:
+                Invoice.post(invoices)
+            self.assertEqual(set_analytic.call_count, 2)
+            # The analytic lines of the moves are validated in one pass
+            validated = [args[0] for args, _ in validate.call_args_list
+                if args[0]]
+            self.assertEqual(len(validated), 1)
+            self.assertEqual(
+                set(validated[0]),
+                {l for i in invoices for l in i.move.lines
+                    if l.account == revenue})
+
+            for invoice in invoices:
+                self.assertEqual(invoice.state, 'posted')
+                line, = [l for l in invoice.move.lines
+                    if l.account == revenue]
+                analytic_line, = line.analytic_lines
+                self.assertEqual(analytic_line.account, project)
+                self.assertEqual(analytic_line.credit, invoice.untaxed_amount)
+                self.assertEqual(analytic_line.date, invoice.invoice_date)
+                self.assertEqual(analytic_line.state, 'valid')
+
+    @with_transaction()
+    def test0200analytic_balance_decimals(self):
+        'Test the analytic lines with decimal amounts are validated'
+        pool = Pool()
+        Account = pool.get('account.account')
+        AnalyticAccount = pool.get('analytic_account.account')
+        AnalyticLine = pool.get('analytic_account.line')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        Party = pool.get('party.party')
+
+        party = Party(name='Party')
+        party.save()
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            fiscalyear.create_period([fiscalyear])
+            period = fiscalyear.periods[0]
+            journal_expense, = Journal.search([
+                    ('code', '=', 'EXP'),
+                    ])
+            expense, = Account.search([
+                    ('type.expense', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            payable, = Account.search([
+                    ('type.payable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            root, = AnalyticAccount.create([{
+                        'name': 'Root',
+                        'type': 'root',
+                        }])
+            project, = AnalyticAccount.create([{
+                        'name': 'Project',
+                        'type': 'normal',
+                        'root': root.id,
+                        'parent': root.id,
+                        }])
+            move, = Move.create([{
+                        'period': period.id,
+                        'journal': journal_expense.id,
+                        'date': period.start_date,
+                        'lines': [('create', [{
+                                        'account': expense.id,
+                                        'debit': Decimal('0.3'),
+                                        }, {
+                                        'party': party.id,
+                                        'account': payable.id,
+                                        'credit': Decimal('0.3'),
+                                        }])],
+                        }])
+            line, = [l for l in move.lines if l.account == expense]
+
+            # The sum of the amounts is not exact with floating point
+            analytic_lines = AnalyticLine.create([{
+                        'account': project.id,
+                        'move_line': line.id,
+                        'debit': Decimal(amount),
+                        'credit': Decimal(0),
+                        'date': period.start_date,
+                        } for amount in ['0.1', '0.2']])
+            self.assertEqual(
+                [l.state for l in analytic_lines], ['valid', 'valid'])
+
 
 del ModuleTestCase
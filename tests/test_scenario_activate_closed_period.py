@@ -0,0 +1,88 @@
+import unittest
+from decimal import Decimal
+
+from proteus import Model, Wizard
+from trytond.modules.account.tests.tools import (create_chart,
+                                                 create_fiscalyear,
+                                                 get_accounts)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def test(self):
+
+        # Activate analytic_account
+        activate_modules('analytic_account')
+
+        # Create company
+        _ = create_company()
+        company = get_company()
+
+        # Create fiscal year
+        fiscalyear = create_fiscalyear(company)
+        fiscalyear.click('create_period')
+        period = fiscalyear.periods[0]
+
+        # Create chart of accounts
+        Journal = Model.get('account.journal')
+        _ = create_chart(company)
+        accounts = get_accounts(company)
+        expense = accounts['expense']
+        payable = accounts['payable']
+        journal_expense, = Journal.find([
+            ('code', '=', 'EXP'),
+        ])
+
+        # Create analytic accounts
+        AnalyticAccount = Model.get('analytic_account.account')
+        root = AnalyticAccount(type='root', name='Root')
+        root.save()
+        analytic_account = AnalyticAccount(root=root,
+                                           parent=root,
+                                           name='Analytic')
+        analytic_account.save()
+
+        # Post a move with an analytic line and close its period
+        Party = Model.get('party.party')
+        supplier = Party(name='Supplier')
+        supplier.save()
+        Move = Model.get('account.move')
+        move = Move()
+        move.period = period
+        move.journal = journal_expense
+        move.date = period.start_date
+        line = move.lines.new()
+        line.account = expense
+        line.debit = Decimal(42)
+        analytic_line = line.analytic_lines.new()
+        analytic_line.debit = line.debit
+        analytic_line.account = analytic_account
+        line = move.lines.new()
+        line.account = payable
+        line.credit = Decimal(42)
+        line.party = supplier
+        move.click('post')
+        period.click('close')
+        self.assertEqual(period.state, 'closed')
+
+        # Activate analytic_line_state on the existing data
+        Module = Model.get('ir.module')
+        module, = Module.find([('name', '=', 'analytic_line_state')])
+        module.click('activate')
+        Wizard('ir.module.activate_upgrade').execute('upgrade')
+
+        # The amounts of the closed period are read from the filled totals
+        analytic_account.reload()
+        self.assertEqual(analytic_account.debit, Decimal(42))
+        self.assertEqual(analytic_account.credit, Decimal(0))